@@ -0,0 +1,185 @@
+import argparse
+import functools
+import json
+import pathlib
+import time
+
+import numpy as np
+
+from gest.annotation.gesture import annotated_gesture_managers
+from gest.inference import (
+    CvCameraInferencePipeline, IMAGE_HEIGHT, IMAGE_WIDTH, UNPACED_QUEUE, add_session_arguments,
+    session_options_from_args,
+)
+from gest.pipeline import Queue
+from gest.sources import IterableSource
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--data-path", help="Annotated data path to replay videos from, instead of synthetic frames")
+parser.add_argument("--frames", help="Number of frames per run", type=int, default=300)
+parser.add_argument("--fps", type=float, default=30, help="Frame rate to replay at, 0 for as fast as possible "
+                    "(frames not taken in time are dropped, like from a camera)")
+parser.add_argument("--modes", nargs='+', help="Pipeline run modes", choices=('sequential', 'threaded'),
+                    default=('sequential', 'threaded'))
+parser.add_argument("--model", help="Model file")
+parser.add_argument("--preallocate", help="Preprocess into preallocated buffers", action="store_true")
+parser.add_argument("--io-binding", help="Run the model with IO binding", action="store_true")
+parser.add_argument("--inference-workers", help="Number of frames inferred in parallel", type=int, default=1)
+parser.add_argument("--queue", help="Pass every frame on through queues of this size in threaded runs, "
+                    f"instead of only the latest (default {UNPACED_QUEUE} with --fps 0)", type=int)
+parser.add_argument("--json", help="Print results as JSON", action="store_true")
+add_session_arguments(parser)
+
+_END = object()
+
+
+def synthetic_frames(count, seed=0):
+    random = np.random.RandomState(seed)
+    return [random.randint(0, 256, (IMAGE_HEIGHT, IMAGE_WIDTH, 3), dtype=np.uint8) for _ in range(count)]
+
+
+def recorded_frames(data_path, count):
+    frames = []
+    for saved in annotated_gesture_managers(data_path)['video'].saved():
+        frames.extend(saved.load().frames)
+        if len(frames) >= count:
+            break
+    if not frames:
+        raise ValueError(f"No recorded videos in {data_path}")
+    return [frames[i % len(frames)] for i in range(count)]
+
+
+def timed(component, durations):
+    """Wraps a pipeline component to record time spent producing each item, excluding waiting for input."""
+    waiting = [0.]
+
+    def waited(items):
+        iterator = iter(items)
+        while True:
+            started = time.perf_counter()
+            item = next(iterator, _END)
+            waiting[0] += time.perf_counter() - started
+            if item is _END:
+                return
+            yield item
+
+    def wrapper(items):
+        outputs = iter(component(waited(items)))
+        while True:
+            started = time.perf_counter()
+            waited_before = waiting[0]
+            item = next(outputs, _END)
+            if item is _END:
+                return
+            durations.append(time.perf_counter() - started - (waiting[0] - waited_before))
+            yield item
+
+    wrapper.__name__ = component.__name__
+    return wrapper
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    return dict(zip(('p50', 'p95', 'p99'), np.percentile(values, (50, 95, 99)).tolist()))
+
+
+def benchmark(pipeline, mode, queue=None):
+    frames = len(pipeline.camera.iterable)
+    durations = {component.__name__: [] for component in pipeline.components}
+    pipeline.components = [timed(component, durations[component.__name__]) for component in pipeline.components]
+    latencies = []
+    started_at = time.perf_counter()
+    cpu_started_at = time.process_time()
+    if mode == 'threaded' and queue is not None:
+        run = pipeline.threaded(channels={
+            component.__name__: functools.partial(Queue, queue) for component in pipeline.components
+        })
+    else:
+        run = getattr(pipeline, mode)()
+    with run as stream:
+        for item in stream:
+            latencies.append(time.monotonic() - item.captured_at)
+    wall_time = time.perf_counter() - started_at
+    skipped = {stage['name']: stage['skipped'] for stage in stream.metrics()} if hasattr(stream, 'metrics') else {}
+    return {
+        'mode': mode,
+        'frames': frames,
+        'results': len(latencies),
+        'wall_time': wall_time,
+        'cpu_time': time.process_time() - cpu_started_at,
+        'throughput': len(latencies) / wall_time,
+        'latency': percentiles(latencies),
+        'stages': {
+            name: {
+                'count': len(values),
+                'skipped': skipped.get(name, 0),
+                'mean': float(np.mean(values)) if values else None,
+                **percentiles(values),
+            }
+            for name, values in durations.items()
+        },
+    }
+
+
+def format_result(result):
+    lines = [
+        f"{result['mode']}: {result['results']}/{result['frames']} frames in {result['wall_time']:.2f}s, "
+        f"{result['throughput']:.1f} fps, cpu {result['cpu_time']:.2f}s",
+        "  latency " + ", ".join(f"{k} {v * 1000:.1f}ms" for k, v in result['latency'].items()),
+    ]
+    for name, stage in result['stages'].items():
+        if stage['count']:
+            lines.append(f"  {name:<16} {stage['count']:>5}x mean {stage['mean'] * 1000:7.2f}ms "
+                         f"p95 {stage['p95'] * 1000:7.2f}ms, {stage['skipped']} skipped")
+    return "\n".join(lines)
+
+
+class App:
+
+    def __init__(self, frames, fps, modes, model_file, preallocate, io_binding, inference_workers, session_options,
+                 queue, as_json):
+        self.frames = frames
+        self.fps = fps
+        self.modes = modes
+        self.queue = queue
+        self.pipeline_kwargs = {
+            'model_file': model_file,
+            'preallocate': preallocate,
+            'io_binding': io_binding,
+            'inference_workers': inference_workers,
+            'session_options': session_options,
+        }
+        self.as_json = as_json
+
+    def run(self):
+        results = [
+            benchmark(CvCameraInferencePipeline(
+                IterableSource(self.frames, fps=self.fps, realtime=bool(self.fps)), **self.pipeline_kwargs,
+            ), mode, self.queue)
+            for mode in self.modes
+        ]
+        if self.as_json:
+            print(json.dumps(results, indent=2))
+        else:
+            for result in results:
+                print(format_result(result))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    App(
+        frames=(
+            recorded_frames(pathlib.Path(args.data_path), args.frames)
+            if args.data_path else synthetic_frames(args.frames)
+        ),
+        fps=args.fps,
+        modes=args.modes,
+        model_file=args.model,
+        preallocate=args.preallocate,
+        io_binding=args.io_binding,
+        inference_workers=args.inference_workers,
+        session_options=session_options_from_args(args),
+        queue=args.queue,
+        as_json=args.json,
+    ).run()
@@ -1,13 +1,25 @@
+import functools
+
 import cv2
 import numpy as np
 
-from gest.math import relative_average_coordinate
+from gest.math import hand_states
 
 LEFT_COLOR = np.array((0., 0., 1.))
 RIGHT_COLOR = np.array((0., 1., 0.))
 OPEN_COLOR = np.array((1., 0., 0.))
 
 
+def color_lut(color):
+    """Maps uint8 intensities to ``color`` scaled by them, as uint8 BGR."""
+    return np.multiply.outer(np.arange(256), color).round().astype(np.uint8)
+
+
+LEFT_LUT = color_lut(LEFT_COLOR)
+RIGHT_LUT = color_lut(RIGHT_COLOR)
+OPEN_LUT = color_lut(OPEN_COLOR)
+
+
 def text(frame, text, scale=1, thickness=1, font=cv2.FONT_HERSHEY_SIMPLEX, point=(0, 1),
          fg=(255, 255, 255), bg=(0, 0, 0)):
     x, y = int(point[0] * frame.shape[1]), int(point[1] * frame.shape[0] - thickness * 10)
@@ -19,6 +31,42 @@ def text(frame, text, scale=1, thickness=1, font=cv2.FONT_HERSHEY_SIMPLEX, point
     return frame
 
 
+@functools.lru_cache(maxsize=512)
+def text_glyph(text, scale=1, thickness=1, font=cv2.FONT_HERSHEY_SIMPLEX, fg=(255, 255, 255), bg=(0, 0, 0)):
+    """Renders ``text`` outlined like ``text()`` does, for ``cached_text`` to blend onto frames.
+
+    Returns the glyph premultiplied by its opacity, its transparency and the text origin within it.
+    """
+    (width, height), baseline = cv2.getTextSize(text, font, scale, thickness)
+    margin = thickness + 1
+    x, y = margin, margin + height
+    on_black, on_white = (
+        np.full((height + baseline + 2 * margin, width + 2 * margin, 3), background, dtype=np.uint8)
+        for background in (0, 255)
+    )
+    for glyph in (on_black, on_white):
+        for point, color in [((x - 1, y), bg), ((x + 1, y), bg), ((x, y - 1), bg), ((x, y + 1), bg), ((x, y), fg)]:
+            cv2.putText(glyph, text, point, font, scale, color, thickness)
+    transparency = (on_white.astype(np.float32) - on_black) / 255
+    return on_black.astype(np.float32), transparency, (x, y)
+
+
+def cached_text(frame, text, scale=1, thickness=1, font=cv2.FONT_HERSHEY_SIMPLEX, point=(0, 1),
+                fg=(255, 255, 255), bg=(0, 0, 0)):
+    """Like ``text()`` for uint8 frames, blending in a glyph rendered once per text and colors."""
+    fg, bg = tuple(int(c) for c in fg), tuple(int(c) for c in bg)
+    glyph, transparency, (origin_x, origin_y) = text_glyph(text, scale, thickness, font, fg, bg)
+    x = int(point[0] * frame.shape[1]) - origin_x
+    y = int(point[1] * frame.shape[0] - thickness * 10) - origin_y
+    top, left = max(y, 0), max(x, 0)
+    bottom, right = min(y + glyph.shape[0], frame.shape[0]), min(x + glyph.shape[1], frame.shape[1])
+    if top < bottom and left < right:
+        region = frame[top:bottom, left:right]
+        crop = np.s_[top - y:bottom - y, left - x:right - x]
+        region[:] = np.rint(glyph[crop] + transparency[crop] * region)
+    return frame
+
+
 def horizontal_line(frame, y: int, color=(0, 0, 255)):
     height, width, *_ = frame.shape
     return cv2.line(
@@ -48,42 +96,57 @@ def crosshead(frame, x, y, color=(0, 0, 255)):
     return frame
 
 
-def show_inference_result(frame, inference_result):
-    (left, open_left), (right, open_right) = inference_result
-    display = np.zeros((*left.shape, 3))
-    np.maximum(display, np.tensordot(left, LEFT_COLOR, axes=0), out=display)
-    np.maximum(display, np.tensordot(right, RIGHT_COLOR, axes=0), out=display)
-    np.maximum(display, np.tensordot(np.maximum(open_left * left, open_right * right), OPEN_COLOR, axes=0), out=display)
-    display = cv2.flip(cv2.resize(display, frame.shape[1::-1]), 1)
-    display = text(display, f'Left: {left.max():.0%}', point=(0, 1))
-    if left.max() > .5:
-        color = np.maximum(LEFT_COLOR, np.multiply(OPEN_COLOR, open_left[left > .5].mean()))
-        display = text(display, f'Open: {open_left[left > .5].mean():.0%}', fg=color, point=(0, .8))
-    display = text(display, f'Right: {right.max():.0%}', point=(.5, 1))
-    if right.max() > .5:
-        color = np.maximum(RIGHT_COLOR, np.multiply(OPEN_COLOR, open_right[right > .5].mean()))
-        display = text(display, f'Open: {open_right[right > .5].mean():.0%}', fg=color, point=(0.5, .8))
-    cv2.imshow('Heatmap', display)
-
-
-def draw_inferred_crossheads(frame, inference_result):
+def render_inference_result(frame, inference_result, hands=None):
+    """Draws the heatmaps, mirrored and scaled to ``frame``, with hand scores, as a uint8 image.
+
+    Colors are looked up at heatmap resolution and the image is upscaled once.
+    """
     (left, open_left), (right, open_right) = inference_result
-    if left.max() > .5:
+    left_hand, right_hand = hands or hand_states(inference_result)
+    levels = np.stack((left, right, np.maximum(open_left * left, open_right * right)))
+    levels = np.clip(levels[:, :, ::-1] * 255, 0, 255).astype(np.uint8)
+    display = np.maximum(np.maximum(LEFT_LUT[levels[0]], RIGHT_LUT[levels[1]]), OPEN_LUT[levels[2]])
+    display = cv2.resize(display, frame.shape[1::-1], interpolation=cv2.INTER_LINEAR)
+    display = cached_text(display, f'Left: {left_hand.score:.0%}', point=(0, 1))
+    if left_hand.score > .5:
+        color = np.maximum(LEFT_COLOR, np.multiply(OPEN_COLOR, left_hand.openness)) * 255
+        display = cached_text(display, f'Open: {left_hand.openness:.0%}', fg=color, point=(0, .8))
+    display = cached_text(display, f'Right: {right_hand.score:.0%}', point=(.5, 1))
+    if right_hand.score > .5:
+        color = np.maximum(RIGHT_COLOR, np.multiply(OPEN_COLOR, right_hand.openness)) * 255
+        display = cached_text(display, f'Open: {right_hand.openness:.0%}', fg=color, point=(0.5, .8))
+    return display
+
+
+def show_inference_result(frame, inference_result, hands=None, combined=False):
+    """Shows the heatmaps, or with ``combined``, ``frame`` and the heatmaps side by side in a single window."""
+    display = render_inference_result(frame, inference_result, hands)
+    if combined:
+        cv2.imshow('Camera', np.hstack((frame, display)))
+    else:
+        cv2.imshow('Heatmap', display)
+
+
+def draw_inferred_crossheads(frame, inference_result, hands=None):
+    left, right = hands or hand_states(inference_result)
+    if left.score > .5:
         frame = crosshead(
             frame,
-            *relative_average_coordinate(left, (1, 0)),
+            left.x,
+            left.y,
             color=np.maximum(
                 LEFT_COLOR,
-                np.multiply(OPEN_COLOR, open_left[left > .5].mean()),
+                np.multiply(OPEN_COLOR, left.openness),
             ) * 255,
         )
-    if right.max() > .5:
+    if right.score > .5:
         frame = crosshead(
             frame,
-            *relative_average_coordinate(right, (1, 0)),
+            right.x,
+            right.y,
             color=np.maximum(
                 RIGHT_COLOR,
-                np.multiply(OPEN_COLOR, open_right[right > .5].mean()),
+                np.multiply(OPEN_COLOR, right.openness),
             ) * 255,
         )
     return frame
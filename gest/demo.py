@@ -1,44 +1,134 @@
 import argparse
+import logging
+import signal
+import sys
+import time
 
 import cv2
 
-from gest.cv_gui import show_inference_result, text, draw_inferred_crossheads
-from gest.inference import CvCameraInferencePipeline
+from gest.cv_gui import cached_text, draw_inferred_crossheads, show_inference_result
+from gest.inference import (
+    CvCameraInferencePipeline, add_capture_arguments, add_scheduler_arguments, add_session_arguments,
+    budget_from_args, capture_options_from_args, flow_tracker_from_args, motion_gate_from_args, scheduler_from_args,
+    session_options_from_args,
+)
 from gest.math import accumulate
+from gest.pipeline import Tracer
+from gest.serve import DEFAULT_SOCKET, RemoteInferencePipeline
+from gest.sources import add_source_arguments, source_from_args
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--camera", help="Camera index", type=int, default=0)
+parser.add_argument("--camera", help="Camera index, or several to infer together", type=int, nargs="+", default=[0])
 parser.add_argument("--model", help="Model file")
+add_source_arguments(parser)
+add_capture_arguments(parser)
+add_session_arguments(parser)
+add_scheduler_arguments(parser)
+parser.add_argument("--log-metrics", help="Pipeline metrics logging interval in seconds", type=float)
+parser.add_argument("--trace", help="File to write a Chrome trace of the last frames to on exit")
+parser.add_argument("--multiprocess", help="Run processing stages in worker processes", action="store_true")
+parser.add_argument("--inference-workers", help="Number of frames inferred in parallel", type=int, default=1)
+parser.add_argument("--preallocate", help="Preprocess into preallocated buffers", action="store_true")
+parser.add_argument("--single-window", help="Show the camera and heatmaps side by side in one window",
+                    action="store_true")
+parser.add_argument("--headless", help="Show no windows, quit on SIGINT or SIGTERM", action="store_true")
+parser.add_argument("--stats-interval", help="Frame rate and latency logging interval in seconds, with --headless",
+                    type=float)
+parser.add_argument("--connect", help="Get results from gest.serve on this socket instead of a camera",
+                    nargs="?", const=DEFAULT_SOCKET)
+
+logger = logging.getLogger(__name__)
 
 
 class App:
 
-    def __init__(self, camera, model_file):
-        self.pipeline = CvCameraInferencePipeline(camera, model_file)
+    def __init__(self, camera, model_file, session_options=None, log_metrics=None, trace_file=None,
+                 multiprocess=False, inference_workers=1, connect=None, scheduler=None,
+                 motion_gate=None, flow_tracker=None, budget=None, capture_options=None, single_window=False,
+                 headless=False, stats_interval=None, preallocate=False):
+        if connect:
+            self.pipeline = RemoteInferencePipeline(connect)
+        else:
+            self.pipeline = CvCameraInferencePipeline(
+                camera, model_file, session_options=session_options, inference_workers=inference_workers,
+                scheduler=scheduler, motion_gate=motion_gate, flow_tracker=flow_tracker,
+                budget=budget, capture_options=capture_options, preallocate=preallocate,
+            )
+        self.log_metrics = log_metrics
+        self.trace_file = trace_file
+        self.tracer = Tracer() if trace_file else None
+        self.multiprocess = multiprocess
+        self.single_window = single_window
+        self.headless = headless
+        self.stats_interval = stats_interval
+
+    def pipeline_run(self):
+        if self.multiprocess:
+            return self.pipeline.multiprocess()
+        return self.pipeline.threaded(log_interval=self.log_metrics, tracer=self.tracer)
 
     def run(self):
         fps = None
         latency = None
-        with self.pipeline.threaded() as stream:
-            for item in stream:
-                fps = accumulate(fps, item.fps)
-                latency = accumulate(latency, item.latency)
-                frame = item.frame
-                frame = draw_inferred_crossheads(frame, item.inference_result)
-                frame = cv2.flip(frame, 1)
-                frame = text(frame, f"fps {fps: 2.0f}", point=(0, .5))
-                frame = text(frame, f"latency {latency:.2f}s", point=(0, .75))
-                frame = text(frame, "Press ESC to quit")
-                cv2.imshow('Camera', frame)
-                show_inference_result(frame, item.inference_result)
-                if cv2.waitKey(1) & 0xFF == 27:  # esc to quit
-                    break
-        cv2.destroyAllWindows()
+        reported_at = time.monotonic()
+        if self.headless:
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+        try:
+            with self.pipeline_run() as stream:
+                for item in stream:
+                    fps = accumulate(fps, item.fps)
+                    latency = accumulate(latency, item.latency)
+                    if self.headless:
+                        if self.stats_interval and time.monotonic() - reported_at >= self.stats_interval:
+                            reported_at = time.monotonic()
+                            logger.info(f"fps {fps:.1f}, latency {latency:.3f}s")
+                    elif self.display(item, fps, latency) == 27:  # esc to quit
+                        break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if not self.headless:
+                cv2.destroyAllWindows()
+            if self.tracer is not None:
+                self.tracer.dump(self.trace_file)
+
+    def display(self, item, fps, latency):
+        """Shows the frame and heatmaps, returning the key pressed."""
+        started = Tracer.clock()
+        frame = item.frame
+        frame = draw_inferred_crossheads(frame, item.inference_result, item.hands)
+        frame = cv2.flip(frame, 1)
+        frame = cached_text(frame, f"fps {fps: 2.0f}", point=(0, .5))
+        frame = cached_text(frame, f"latency {latency:.2f}s", point=(0, .75))
+        frame = cached_text(frame, "Press ESC to quit")
+        if not self.single_window:
+            cv2.imshow('Camera', frame)
+        show_inference_result(frame, item.inference_result, item.hands, combined=self.single_window)
+        key = cv2.waitKey(1) & 0xFF
+        if self.tracer is not None:
+            self.tracer.record('display', item, started, Tracer.clock())
+        return key
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
     App(
-        camera=args.camera,
+        camera=source_from_args(args),
         model_file=args.model,
+        session_options=session_options_from_args(args),
+        capture_options=capture_options_from_args(args),
+        log_metrics=args.log_metrics,
+        trace_file=args.trace,
+        multiprocess=args.multiprocess,
+        inference_workers=args.inference_workers,
+        connect=args.connect,
+        scheduler=scheduler_from_args(args),
+        motion_gate=motion_gate_from_args(args),
+        flow_tracker=flow_tracker_from_args(args),
+        budget=budget_from_args(args),
+        single_window=args.single_window,
+        headless=args.headless,
+        stats_interval=args.stats_interval,
+        preallocate=args.preallocate,
     ).run()
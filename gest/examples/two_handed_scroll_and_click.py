@@ -1,24 +1,61 @@
 import argparse
+import logging
+import signal
+import sys
 import threading
 import time
 
 import cv2
 import pynput.mouse
 
-from gest.cv_gui import text, draw_inferred_crossheads, show_inference_result
-from gest.inference import CvCameraInferencePipeline
-from gest.math import relative_average_coordinate
+from gest.cv_gui import cached_text, draw_inferred_crossheads, show_inference_result
+from gest.inference import (
+    CvCameraInferencePipeline, add_capture_arguments, add_scheduler_arguments, add_session_arguments,
+    budget_from_args, capture_options_from_args, flow_tracker_from_args, motion_gate_from_args, scheduler_from_args,
+    session_options_from_args,
+)
+from gest.math import accumulate
+from gest.serve import DEFAULT_SOCKET, RemoteInferencePipeline
+from gest.sources import add_source_arguments, source_from_args
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--camera", help="Camera index", type=int, default=0)
+parser.add_argument("--camera", help="Camera index, or several to infer together", type=int, nargs="+", default=[0])
 parser.add_argument("--model", help="Model file")
 parser.add_argument("--sensitivity", help="Scrolling sensitivity", type=int, default=50)
+add_source_arguments(parser)
+add_capture_arguments(parser)
+add_session_arguments(parser)
+add_scheduler_arguments(parser)
+parser.add_argument("--preallocate", help="Preprocess into preallocated buffers", action="store_true")
+parser.add_argument("--log-metrics", help="Pipeline metrics logging interval in seconds", type=float)
+parser.add_argument("--single-window", help="Show the camera and heatmaps side by side in one window",
+                    action="store_true")
+parser.add_argument("--headless", help="Show no windows, quit on SIGINT or SIGTERM", action="store_true")
+parser.add_argument("--stats-interval", help="Frame rate and latency logging interval in seconds, with --headless",
+                    type=float)
+parser.add_argument("--connect", help="Get results from gest.serve on this socket instead of a camera",
+                    nargs="?", const=DEFAULT_SOCKET)
+
+logger = logging.getLogger(__name__)
 
 
 class App:
 
-    def __init__(self, camera, model_file, scrolling_sensitivity):
-        self.pipeline = CvCameraInferencePipeline(camera, model_file)
+    def __init__(self, camera, model_file, scrolling_sensitivity, session_options=None, log_metrics=None,
+                 connect=None, scheduler=None, motion_gate=None, flow_tracker=None, budget=None,
+                 capture_options=None, single_window=False, headless=False, stats_interval=None, preallocate=False):
+        if connect:
+            self.pipeline = RemoteInferencePipeline(connect)
+        else:
+            self.pipeline = CvCameraInferencePipeline(
+                camera, model_file, session_options=session_options, scheduler=scheduler,
+                motion_gate=motion_gate, flow_tracker=flow_tracker, budget=budget,
+                capture_options=capture_options, preallocate=preallocate,
+            )
+        self.log_metrics = log_metrics
+        self.single_window = single_window
+        self.headless = headless
+        self.stats_interval = stats_interval
         self.mouse = pynput.mouse.Controller()
 
         self.scrolling_sensitivity = scrolling_sensitivity
@@ -43,70 +80,102 @@ class App:
         button_down = None
         button_down_since = None
         last_click = None
-        with self.pipeline.threaded() as stream:
-            for item in stream:
-                now = item.captured_at
-                frame = item.frame
-                inference_result = item.inference_result
-                (left, open_left), (right, open_right) = inference_result
-
-                # actions
-                left_x, left_y = relative_average_coordinate(left, (1, 0))
-                right_x, right_y = relative_average_coordinate(right, (1, 0))
-                button_down_now = None
-                scroll_now = 0
-
-                if left.max() < self.score_threshold or right.max() < self.score_threshold:
-                    pass
-                elif open_left[left > .5].mean() > .5 and open_right[right > .5].mean() > .5:
-                    button_down_now = 'drag'
-                elif open_left[left > .5].mean() > .5 or open_right[right > .5].mean() > .5:
-                    pass
-                elif left_x < right_x:
-                    button_down_now = 'double click'
-                elif abs(left_y - right_y) < .05:
-                    if left_x - right_x < .1:
-                        button_down_now = 'click'
-                    else:
-                        button_down_now = 'right click'
-                elif abs(left_y - right_y) > .08:
-                    scroll_now = left_y - right_y
-
-                if button_down != button_down_now:
-                    button_down_since = now
-                    if button_down == 'drag':
-                        self.mouse.release(pynput.mouse.Button.left)
-                    if button_down_now == 'drag' and (last_click is None or now - last_click > .5):
-                        self.mouse.press(pynput.mouse.Button.left)
+        fps = None
+        latency = None
+        reported_at = time.monotonic()
+        if self.headless:
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+        try:
+            with self.pipeline.threaded(log_interval=self.log_metrics) as stream:
+                for item in stream:
+                    now = item.captured_at
+                    left, right = item.hands
+
+                    # actions
+                    button_down_now = None
+                    scroll_now = 0
+
+                    if left.score < self.score_threshold or right.score < self.score_threshold:
+                        pass
+                    elif left.openness > .5 and right.openness > .5:
+                        button_down_now = 'drag'
+                    elif left.openness > .5 or right.openness > .5:
+                        pass
+                    elif left.x < right.x:
+                        button_down_now = 'double click'
+                    elif abs(left.y - right.y) < .05:
+                        if left.x - right.x < .1:
+                            button_down_now = 'click'
+                        else:
+                            button_down_now = 'right click'
+                    elif abs(left.y - right.y) > .08:
+                        scroll_now = left.y - right.y
+
+                    if button_down != button_down_now:
+                        button_down_since = now
+                        if button_down == 'drag':
+                            self.mouse.release(pynput.mouse.Button.left)
+                        if button_down_now == 'drag' and (last_click is None or now - last_click > .5):
+                            self.mouse.press(pynput.mouse.Button.left)
+                            last_click = now
+                        if button_down_now == 'click' and (last_click is None or now - last_click > .5):
+                            self.mouse.click(pynput.mouse.Button.left)
+                            last_click = now
+                        if button_down_now == 'double click' and (last_click is None or now - last_click > .5):
+                            self.mouse.click(pynput.mouse.Button.left, 2)
+                            last_click = now
+                        button_down = button_down_now
+                    elif button_down_now == 'right click' and .5 < now - button_down_since and \
+                            (last_click is None or last_click < button_down_since):
+                        self.mouse.click(pynput.mouse.Button.right)
                         last_click = now
-                    if button_down_now == 'click' and (last_click is None or now - last_click > .5):
-                        self.mouse.click(pynput.mouse.Button.left)
-                        last_click = now
-                    if button_down_now == 'double click' and (last_click is None or now - last_click > .5):
-                        self.mouse.click(pynput.mouse.Button.left, 2)
-                        last_click = now
-                    button_down = button_down_now
-                elif button_down_now == 'right click' and .5 < now - button_down_since and \
-                        (last_click is None or last_click < button_down_since):
-                    self.mouse.click(pynput.mouse.Button.right)
-                    last_click = now
-
-                self.scrolling_speed = scroll_now
-
-                frame = draw_inferred_crossheads(frame, inference_result)
-                cv2.imshow('Camera', text(cv2.flip(frame, 1), "Press ESC to quit"))
-                show_inference_result(frame, inference_result)
-
-                if cv2.waitKey(1) & 0xFF == 27:  # esc to quit
-                    break
 
-        cv2.destroyAllWindows()
+                    self.scrolling_speed = scroll_now
+
+                    if self.headless:
+                        fps = accumulate(fps, item.fps)
+                        latency = accumulate(latency, item.latency)
+                        if self.stats_interval and time.monotonic() - reported_at >= self.stats_interval:
+                            reported_at = time.monotonic()
+                            logger.info(f"fps {fps:.1f}, latency {latency:.3f}s")
+                    elif self.display(item) == 27:  # esc to quit
+                        break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.scrolling_speed = 0
+            if button_down == 'drag':
+                self.mouse.release(pynput.mouse.Button.left)
+            if not self.headless:
+                cv2.destroyAllWindows()
+
+    def display(self, item):
+        """Shows the frame and heatmaps, returning the key pressed."""
+        frame = draw_inferred_crossheads(item.frame, item.inference_result, item.hands)
+        frame = cached_text(cv2.flip(frame, 1), "Press ESC to quit")
+        if not self.single_window:
+            cv2.imshow('Camera', frame)
+        show_inference_result(frame, item.inference_result, item.hands, combined=self.single_window)
+        return cv2.waitKey(1) & 0xFF
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
     App(
-        camera=args.camera,
+        camera=source_from_args(args),
         model_file=args.model,
         scrolling_sensitivity=args.sensitivity,
+        session_options=session_options_from_args(args),
+        capture_options=capture_options_from_args(args),
+        log_metrics=args.log_metrics,
+        connect=args.connect,
+        scheduler=scheduler_from_args(args),
+        motion_gate=motion_gate_from_args(args),
+        flow_tracker=flow_tracker_from_args(args),
+        budget=budget_from_args(args),
+        single_window=args.single_window,
+        headless=args.headless,
+        stats_interval=args.stats_interval,
+        preallocate=args.preallocate,
     ).run()
@@ -0,0 +1,117 @@
+import argparse
+import pathlib
+
+import numpy as np
+import onnx
+import onnxruntime
+from onnx import helper, numpy_helper
+
+from gest.inference import (
+    DEFAULT_MODEL_FILE, IMAGE_HEIGHT, IMAGE_OFFSET, IMAGE_SCALE, IMAGE_WIDTH, INPUT_SIZES, make_input_size_dynamic,
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("output", help="Folded model file")
+parser.add_argument("--model", help="Model file")
+parser.add_argument("--input-size", help="Frame resolution the folded model takes", choices=INPUT_SIZES,
+                    default=f'{IMAGE_WIDTH}x{IMAGE_HEIGHT}')
+
+
+def heatmap_size(model, input_size):
+    width, height = input_size
+    session = onnxruntime.InferenceSession(model.SerializeToString())
+    output, = session.run(['output'], {'input': np.zeros((2, 3, height, width), dtype=np.float32)})
+    return output.shape[-1], output.shape[-2]
+
+
+def fold_bgr_to_rgb(model):
+    """Reorders the input channel weights of the first convolution to take BGR, returning whether it could."""
+    consumers = [node for node in model.graph.node if 'input' in node.input]
+    if len(consumers) != 1 or consumers[0].op_type != 'Conv' or consumers[0].input[0] != 'input':
+        return False
+    weights, = [tensor for tensor in model.graph.initializer if tensor.name == consumers[0].input[1]]
+    weights.CopyFrom(numpy_helper.from_array(numpy_helper.to_array(weights)[:, ::-1].copy(), weights.name))
+    return True
+
+
+def fold(model, input_size):
+    """Wraps ``model`` into one taking a batch of BGR frames as captured and returning left and right hand heatmaps.
+
+    Does in the graph what ``InferenceSession.cv2_preprocess`` and ``postprocess`` do:
+    the input named ``frame`` is uint8 of ``(frames, height, width, 3)``, and the output
+    of ``(frames, 2, 2, heatmap height, heatmap width)`` has the left and right hand of each frame,
+    as heatmaps and openness, the right ones flipped back.
+    """
+    width, height = input_size
+    make_input_size_dynamic(model)
+    output_width, output_height = heatmap_size(model, input_size)
+    bgr = fold_bgr_to_rgb(model)
+    constants = [
+        *([] if bgr else [numpy_helper.from_array(np.asarray([2, 1, 0], dtype=np.int64), 'gest_bgr_to_rgb')]),
+        numpy_helper.from_array((IMAGE_SCALE[::-1] if bgr else IMAGE_SCALE).reshape(1, 3, 1, 1), 'gest_scale'),
+        numpy_helper.from_array((IMAGE_OFFSET[::-1] if bgr else IMAGE_OFFSET).reshape(1, 3, 1, 1), 'gest_offset'),
+        numpy_helper.from_array(np.arange(width - 1, -1, -1, dtype=np.int64), 'gest_flip_input'),
+        numpy_helper.from_array(np.asarray([-1, 3, height, width], dtype=np.int64), 'gest_input_shape'),
+        numpy_helper.from_array(np.asarray([-1, 2, 2, output_height, output_width], dtype=np.int64), 'gest_pairs'),
+        numpy_helper.from_array(np.asarray(0, dtype=np.int64), 'gest_normal'),
+        numpy_helper.from_array(np.asarray(1, dtype=np.int64), 'gest_mirrored'),
+        numpy_helper.from_array(np.arange(output_width - 1, -1, -1, dtype=np.int64), 'gest_flip_output'),
+    ]
+    preprocessing = [
+        # mirrored while still compact, as whole pixels
+        helper.make_node('Gather', ['frame', 'gest_flip_input'], ['gest_flipped'], axis=2),
+        # interleaved, like normal and mirrored copies of each frame in turn from cv2_preprocess_batch
+        helper.make_node('Unsqueeze', ['frame'], ['gest_normal_pair'], axes=[1]),
+        helper.make_node('Unsqueeze', ['gest_flipped'], ['gest_mirrored_pair'], axes=[1]),
+        helper.make_node('Concat', ['gest_normal_pair', 'gest_mirrored_pair'], ['gest_pair'], axis=1),
+        helper.make_node('Cast', ['gest_pair'], ['gest_float'], to=onnx.TensorProto.FLOAT),
+        *([] if bgr else [helper.make_node('Gather', ['gest_float', 'gest_bgr_to_rgb'], ['gest_float_rgb'], axis=4)]),
+        helper.make_node('Transpose', ['gest_float' if bgr else 'gest_float_rgb'], ['gest_chw'], perm=[0, 1, 4, 2, 3]),
+        helper.make_node('Reshape', ['gest_chw', 'gest_input_shape'], ['gest_batch']),
+        helper.make_node('Mul', ['gest_batch', 'gest_scale'], ['gest_scaled']),
+        helper.make_node('Sub', ['gest_scaled', 'gest_offset'], ['input']),
+    ]
+    postprocessing = [
+        helper.make_node('Reshape', ['gest_model_output', 'gest_pairs'], ['gest_output_pairs']),
+        helper.make_node('Gather', ['gest_output_pairs', 'gest_normal'], ['gest_left'], axis=1),
+        helper.make_node('Gather', ['gest_output_pairs', 'gest_mirrored'], ['gest_flipped_right'], axis=1),
+        helper.make_node('Gather', ['gest_flipped_right', 'gest_flip_output'], ['gest_right'], axis=3),
+        helper.make_node('Unsqueeze', ['gest_left'], ['gest_left_hand'], axes=[1]),
+        helper.make_node('Unsqueeze', ['gest_right'], ['gest_right_hand'], axes=[1]),
+        helper.make_node('Concat', ['gest_left_hand', 'gest_right_hand'], ['output'], axis=1),
+    ]
+    for node in model.graph.node:
+        node.output[:] = ['gest_model_output' if name == 'output' else name for name in node.output]
+    graph = helper.make_graph(
+        [*preprocessing, *model.graph.node, *postprocessing],
+        model.graph.name,
+        [helper.make_tensor_value_info('frame', onnx.TensorProto.UINT8, ['frames', height, width, 3])],
+        [helper.make_tensor_value_info(
+            'output', onnx.TensorProto.FLOAT, ['frames', 2, 2, output_height, output_width],
+        )],
+        [*model.graph.initializer, *constants],
+    )
+    folded = helper.make_model(graph, opset_imports=model.opset_import, producer_name='gest.fold')
+    folded.ir_version = model.ir_version
+    onnx.checker.check_model(folded)
+    return folded
+
+
+class App:
+
+    def __init__(self, model_file, output_file, input_size):
+        self.model_file = pathlib.Path(model_file or DEFAULT_MODEL_FILE)
+        self.output_file = output_file
+        self.input_size = input_size
+
+    def run(self):
+        onnx.save(fold(onnx.load(str(self.model_file)), self.input_size), str(self.output_file))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    App(
+        model_file=args.model,
+        output_file=pathlib.Path(args.output),
+        input_size=INPUT_SIZES[args.input_size],
+    ).run()
@@ -1,46 +1,695 @@
+import collections
+import copy
+import functools
+import hashlib
+import logging
+import os
 import pathlib
+import tempfile
+import threading
 import time
+import weakref
 
 import cv2
 import numpy as np
 import onnxruntime
 
-from gest.pipeline import Pipeline, Factory
+try:
+    import onnx
+except ImportError:
+    onnx = None
+
+from gest.math import hand_states
+from gest.pipeline import Pipeline, Factory, Parallel, Queue
+from gest.sources import FrameSource
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_MODEL_FILE = pathlib.Path(__file__).parent / 'GES-147.onnx'
 IMAGE_WIDTH = 320
 IMAGE_HEIGHT = 240
-IMAGE_MEAN = np.asarray([0.485, 0.456, 0.406])[:, None, None]
-IMAGE_STDDEV = np.asarray([0.229, 0.224, 0.225])[:, None, None]
+IMAGE_MEAN = np.asarray([0.485, 0.456, 0.406], dtype=np.float32)[:, None, None]
+IMAGE_STDDEV = np.asarray([0.229, 0.224, 0.225], dtype=np.float32)[:, None, None]
+# (x / 255 - mean) / stddev == x * IMAGE_SCALE - IMAGE_OFFSET, per RGB channel
+IMAGE_SCALE = (1 / (255 * IMAGE_STDDEV)).ravel().astype(np.float32)
+IMAGE_OFFSET = (IMAGE_MEAN / IMAGE_STDDEV).ravel().astype(np.float32)
+INPUT_SHAPE = (2, 3, IMAGE_HEIGHT, IMAGE_WIDTH)
+# (width, height) from the largest, multiples of the model's output stride of 8, so heatmap cells cover the frame evenly
+INPUT_SIZES = {
+    '320x240': (320, 240),
+    '256x192': (256, 192),
+    '192x144': (192, 144),
+    '160x120': (160, 120),
+}
+EXECUTION_MODES = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+CAPTURE_BACKENDS = {
+    'any': cv2.CAP_ANY,
+    'v4l2': cv2.CAP_V4L2,
+    'dshow': cv2.CAP_DSHOW,
+    'msmf': cv2.CAP_MSMF,
+    'avfoundation': cv2.CAP_AVFOUNDATION,
+    'gstreamer': cv2.CAP_GSTREAMER,
+    'ffmpeg': cv2.CAP_FFMPEG,
+}
+DEFAULT_CACHE_DIR = pathlib.Path(os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache')) / 'gest'
+# unpaced frames come as fast as they're read, so threaded runs queue this many between stages rather than skip them
+UNPACED_QUEUE = 4
+
+
+def add_scheduler_arguments(parser):
+    parser.add_argument("--idle-after", help="Seconds without a hand in view before inferring less often", type=float)
+    parser.add_argument("--idle-fps", help="Frame rate while no hand is in view", type=float, default=4.)
+    parser.add_argument("--detection-threshold", type=float, default=.5,
+                        help="Hand score counting as a hand in view, keeping the full frame rate")
+    parser.add_argument("--wake-threshold", type=float, default=.3,
+                        help="Hand score restoring the full frame rate while idle")
+    gating = parser.add_mutually_exclusive_group()
+    gating.add_argument("--motion-threshold", type=float,
+                        help="Reuse the last result for frames differing from the last inferred one less than this, "
+                             "like 0.02")
+    gating.add_argument("--infer-every", type=int,
+                        help="Infer only every n-th frame, moving results along with optical flow in between")
+    parser.add_argument("--refresh-interval", help="Infer at least every n-th frame with --motion-threshold",
+                        type=int, default=10)
+    parser.add_argument("--max-cpu", type=float,
+                        help="Adjust settings to use at most this many cores, like 0.25 for a quarter of one")
+    parser.add_argument("--min-fps", help="Adjust settings to infer at least this many frames per second", type=float)
+
+
+def budget_from_args(args):
+    if args.max_cpu is None and args.min_fps is None:
+        return None
+    return BudgetController(max_cpu=args.max_cpu, min_fps=args.min_fps, max_threads=args.intra_op_threads)
+
+
+def motion_gate_from_args(args):
+    if args.infer_every is not None:
+        return MotionGate(threshold=float('inf'), refresh_interval=args.infer_every)
+    if args.motion_threshold is None:
+        return None
+    return MotionGate(threshold=args.motion_threshold, refresh_interval=args.refresh_interval)
+
+
+def flow_tracker_from_args(args):
+    if args.infer_every is None:
+        return None
+    return FlowTracker()
+
+
+def scheduler_from_args(args):
+    if args.idle_after is None:
+        return None
+    return IdleScheduler(
+        idle_after=args.idle_after, idle_fps=args.idle_fps,
+        detection_threshold=args.detection_threshold, wake_threshold=args.wake_threshold,
+    )
+
+
+def add_session_arguments(parser):
+    parser.add_argument("--intra-op-threads", help="ONNX Runtime intra-op thread count", type=int)
+    parser.add_argument("--inter-op-threads", help="ONNX Runtime inter-op thread count", type=int)
+    parser.add_argument("--execution-mode", help="ONNX Runtime execution mode", choices=EXECUTION_MODES)
+    parser.add_argument("--graph-optimization", help="ONNX Runtime graph optimization level",
+                        choices=GRAPH_OPTIMIZATION_LEVELS)
+    parser.add_argument("--no-spinning", help="Let idle ONNX Runtime threads sleep instead of spinning",
+                        action="store_true")
+    parser.add_argument("--cache-dir", help="Optimized model cache directory", nargs="?",
+                        const=DEFAULT_CACHE_DIR, type=pathlib.Path)
+    parser.add_argument("--input-size", help="Model input resolution, or the largest meeting --target-latency",
+                        choices=(*INPUT_SIZES, 'auto'))
+    parser.add_argument("--target-latency", help="Inference time in seconds for --input-size auto",
+                        type=float, default=.03)
+
+
+def session_options_from_args(args):
+    options = {
+        'intra_op_num_threads': args.intra_op_threads,
+        'inter_op_num_threads': args.inter_op_threads,
+        'execution_mode': args.execution_mode,
+        'graph_optimization_level': args.graph_optimization,
+        'allow_spinning': False if args.no_spinning else None,
+        'cache_dir': args.cache_dir,
+    }
+    if args.input_size == 'auto':
+        options['input_size'] = select_input_size(args.target_latency, args.model, **options)
+    else:
+        options['input_size'] = INPUT_SIZES.get(args.input_size)
+    return options
+
+
+def select_input_size(target_latency, model_file=None, repeat=10, **session_options):
+    """Returns the largest of ``INPUT_SIZES`` inferred within ``target_latency`` seconds here, or the smallest."""
+    for name, size in INPUT_SIZES.items():
+        session = InferenceSession(model_file, input_size=size, **session_options)
+        input = np.zeros(session.input_shape, dtype=np.float32)
+        session.onnx_run(input)
+        latencies = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            session.onnx_run(input)
+            latencies.append(time.perf_counter() - started)
+        latency = float(np.median(latencies))
+        logger.info(f"Inference at {name} takes {latency * 1000:.1f}ms")
+        if latency <= target_latency:
+            break
+    return size
+
+
+def make_input_size_dynamic(model):
+    """Makes the input and output height and width of a model symbolic, returning whether they were fixed."""
+    fixed = False
+    # heatmaps are smaller than the input, so outputs get symbols of their own
+    for values, height, width in ((model.graph.input, 'height', 'width'),
+                                  (model.graph.output, 'heatmap_height', 'heatmap_width')):
+        for value in values:
+            dim = value.type.tensor_type.shape.dim
+            fixed = fixed or any(dim[axis].HasField('dim_value') for axis in (2, 3))
+            dim[2].dim_param, dim[3].dim_param = height, width
+    del model.graph.value_info[:]
+    return fixed
+
+
+def dynamic_input_size_model(model_file, cache_dir):
+    """Returns the model with symbolic input and output height and width, converting it if they are fixed."""
+    if onnx is None:
+        raise ImportError("Changing the model input size requires onnx, install gest[models]")
+    model = onnx.load(str(model_file))
+    if model.graph.input[0].name == 'frame':
+        raise ValueError("Folded models have a fixed input size, fold the model again at another size")
+    converted = cache_dir / f'{model_file.stem}-dynamic-{hashlib.sha256(model_file.read_bytes()).hexdigest()[:16]}.onnx'
+    if converted.exists():
+        return converted
+    if not make_input_size_dynamic(model):
+        return model_file
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # written aside and renamed, so that concurrent runs never load a partial file
+    descriptor, saved = tempfile.mkstemp(suffix='.onnx', dir=cache_dir)
+    os.close(descriptor)
+    onnx.save(model, saved)
+    os.replace(saved, converted)
+    return converted
+
+
+def add_capture_arguments(parser):
+    parser.add_argument("--capture-backend", help="OpenCV video capture backend", choices=CAPTURE_BACKENDS)
+    parser.add_argument("--fourcc", help="Camera pixel format, like MJPG")
+    parser.add_argument("--low-latency", help="Keep a single buffered frame, grabbed as it comes in its own thread",
+                        action="store_true")
+
+
+def capture_options_from_args(args):
+    return {
+        'backend': args.capture_backend,
+        'fourcc': args.fourcc,
+        'buffer_size': 1 if args.low_latency else None,
+        'grab_thread': args.low_latency,
+    }
+
+
+class FrameGrabber:
+    """Grabs frames from a video capture in a thread as they come, and decodes only those read.
+
+    The camera's buffer then never fills up with stale frames while the pipeline is busy.
+    Frames are grabbed, decoded and configured on the grab thread only, as some backends require.
+    """
+
+    def __init__(self, capture):
+        self.capture = capture
+        self.condition = threading.Condition()
+        self.requested = False
+        self.closed = False
+        self.grabbed_at = None
+        self.frame = None
+        self.properties = []
+        self.thread = threading.Thread(target=self.grab_forever, name='grab', daemon=True)
+        self.thread.start()
+
+    def grab_forever(self):
+        while not self.closed:
+            with self.condition:
+                properties, self.properties = self.properties, []
+            for property_id, value in properties:
+                self.capture.set(property_id, value)
+            grabbed = self.capture.grab()
+            grabbed_at = time.monotonic()
+            with self.condition:
+                if not grabbed:
+                    self.closed = True
+                elif self.requested:
+                    retrieved, self.frame = self.capture.retrieve()
+                    self.grabbed_at = grabbed_at
+                    self.requested = False
+                    self.closed = not retrieved
+                self.condition.notify_all()
+
+    def read(self):
+        """Returns whether a frame was read, the time it was grabbed at and the frame grabbed next."""
+        self.request()
+        return self.wait()
+
+    def request(self):
+        """Asks for the next frame grabbed, so that several grabbers can be read from at once."""
+        with self.condition:
+            self.requested = True
+
+    def wait(self):
+        """Returns what ``read`` does, once the frame asked for is grabbed."""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.requested or self.closed)
+            if self.requested:
+                return False, None, None
+            return True, self.grabbed_at, self.frame
+
+    def set(self, property_id, value):
+        with self.condition:
+            self.properties.append((property_id, value))
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+        self.thread.join()
+
+
+class BufferLease:
+    """Exposes a pool buffer through the array interface, so that every view of it keeps the lease."""
+
+    __array_interface__ = None
+
+
+class BufferPool:
+    """Preallocated arrays, each lent to one owner at a time.
+
+    A buffer returns to the pool on ``release(owner)``, or once its owner, like a pipeline item,
+    is garbage collected, so that items a channel drops on the way don't keep theirs.
+    A buffer in use is never handed out again, so ``acquire`` waits for one to be returned.
+    """
+
+    def __init__(self, shape, dtype=np.float32, size=3):
+        self.buffers = [np.empty(shape, dtype=dtype) for _ in range(size)]
+        self.free = list(range(size))
+        self.leases = {}
+        # reentrant, as an owner may be collected, and its buffer returned, on a thread holding it
+        self.condition = threading.Condition(threading.RLock())
+
+    def acquire(self, owner, timeout=None):
+        """Lends a buffer to ``owner``, or returns None if none was returned within ``timeout`` seconds."""
+        with self.condition:
+            if id(owner) in self.leases:
+                raise ValueError("Each owner can hold a single buffer of a pool")
+            if not self.condition.wait_for(lambda: self.free, timeout):
+                return None
+            index = self.free.pop()
+            self.leases[id(owner)] = weakref.finalize(owner, self.returned, id(owner), index)
+            return self.buffers[index]
+
+    def lend(self, timeout=None):
+        """Lends a buffer until it and all views of it are garbage collected, or returns None like ``acquire``."""
+        lease = BufferLease()
+        buffer = self.acquire(lease, timeout)
+        if buffer is None:
+            return None
+        lease.__array_interface__ = buffer.__array_interface__
+        return np.asarray(lease)
+
+    def returned(self, key, index):
+        with self.condition:
+            del self.leases[key]
+            self.free.append(index)
+            self.condition.notify()
+
+    def release(self, owner):
+        """Returns the buffer lent to ``owner``, if it holds one."""
+        with self.condition:
+            lease = self.leases.get(id(owner))
+        if lease is not None:
+            lease()
+
+    def __reduce__(self):
+        buffer = self.buffers[0]
+        return BufferPool, (buffer.shape, buffer.dtype, len(self.buffers))
 
 
 class InferenceSession:
 
-    def __init__(self, model_file=None):
-        self.onnx_inference_session = onnxruntime.InferenceSession(str(model_file or DEFAULT_MODEL_FILE))
+    def __init__(self, model_file=None, intra_op_num_threads=None, inter_op_num_threads=None,
+                 execution_mode=None, graph_optimization_level=None, allow_spinning=None, cache_dir=None,
+                 input_size=None):
+        self.arguments = (
+            model_file, intra_op_num_threads, inter_op_num_threads,
+            execution_mode, graph_optimization_level, allow_spinning, cache_dir, input_size,
+        )
+        # (width, height)
+        self.input_size = tuple(input_size or (IMAGE_WIDTH, IMAGE_HEIGHT))
+        self.input_shape = (INPUT_SHAPE[0], INPUT_SHAPE[1], self.input_size[1], self.input_size[0])
+        self._onnx_inference_session = self.create_onnx_inference_session()
+        input, = self.onnx_inference_session.get_inputs()
+        self.input_name = input.name
+        # models from gest.fold take BGR frames as they are, and flip right hand heatmaps back themselves
+        self.folded = input.name == 'frame'
+        if self.folded:
+            _, height, width, _ = input.shape
+            self.input_size = (width, height)
+            self.input_shape = (1, height, width, 3)
+        self.input_dtype = np.uint8 if self.folded else np.float32
+        self.input_buffer = np.empty(self.input_shape, dtype=self.input_dtype)
+        self._resized = np.empty((self.input_size[1], self.input_size[0], 3), dtype=np.uint8)
+        self._io_binding = None
+
+    def create_onnx_inference_session(self):
+        (model_file, intra_op_num_threads, inter_op_num_threads,
+         execution_mode, graph_optimization_level, allow_spinning, cache_dir, input_size) = self.arguments
+        model_file = pathlib.Path(model_file or DEFAULT_MODEL_FILE)
+        if tuple(input_size or (IMAGE_WIDTH, IMAGE_HEIGHT)) != (IMAGE_WIDTH, IMAGE_HEIGHT):
+            model_file = dynamic_input_size_model(model_file, pathlib.Path(cache_dir or DEFAULT_CACHE_DIR))
+        options = onnxruntime.SessionOptions()
+        if intra_op_num_threads is not None:
+            options.intra_op_num_threads = intra_op_num_threads
+        if inter_op_num_threads is not None:
+            options.inter_op_num_threads = inter_op_num_threads
+        if execution_mode is not None:
+            options.execution_mode = EXECUTION_MODES[execution_mode]
+        if graph_optimization_level is not None:
+            options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[graph_optimization_level]
+        if allow_spinning is not None:
+            options.add_session_config_entry('session.intra_op.allow_spinning', str(int(allow_spinning)))
+            options.add_session_config_entry('session.inter_op.allow_spinning', str(int(allow_spinning)))
+        if cache_dir is not None:
+            model_file = self.cached_optimized_model(model_file, options, pathlib.Path(cache_dir))
+        return onnxruntime.InferenceSession(str(model_file), options)
+
+    @property
+    def onnx_inference_session(self):
+        if self._onnx_inference_session is None:
+            self._onnx_inference_session = self.create_onnx_inference_session()
+        return self._onnx_inference_session
+
+    def __getstate__(self):
+        # ONNX Runtime sessions can't be pickled, so other processes create their own, once they run the model
+        return {**self.__dict__, '_onnx_inference_session': None, '_io_binding': None}
 
     @staticmethod
-    def cv2_preprocess(frame):
+    def cached_optimized_model(model_file, options, cache_dir):
+        """Returns the cached optimized graph, saving it first if missing, and sets ``options`` up to load it.
+
+        Layout optimizations of ``ORT_ENABLE_ALL`` are specific to the CPU, so the graph is saved
+        optimized up to ``ORT_ENABLE_EXTENDED``, and only they run again when it's loaded.
+        """
+        levels = onnxruntime.GraphOptimizationLevel
+        level = options.graph_optimization_level
+        saved_level = levels.ORT_ENABLE_EXTENDED if level == levels.ORT_ENABLE_ALL else level
+        key = hashlib.sha256(model_file.read_bytes())
+        key.update(f'{onnxruntime.__version__}:{saved_level}'.encode())
+        cached = cache_dir / f'{model_file.stem}-{key.hexdigest()[:16]}.onnx'
+        if not cached.exists():
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            # written aside and renamed, so that concurrent runs never load a partial file
+            descriptor, saved = tempfile.mkstemp(suffix='.onnx', dir=cache_dir)
+            os.close(descriptor)
+            saving = onnxruntime.SessionOptions()
+            saving.graph_optimization_level = saved_level
+            saving.optimized_model_filepath = saved
+            onnxruntime.InferenceSession(str(model_file), saving)
+            os.replace(saved, cached)
+        if level != levels.ORT_ENABLE_ALL:
+            options.graph_optimization_level = levels.ORT_DISABLE_ALL
+        return cached
+
+    @property
+    def output_shape(self):
+        _, *shape = self.onnx_inference_session.get_outputs()[0].shape
+        if not all(isinstance(dim, int) for dim in shape):
+            # symbolic, as after changing the input size, so found by running the model once
+            return self.onnx_run(np.zeros(self.input_shape, dtype=self.input_dtype))[0].shape
+        return (self.input_shape[0], *shape)
+
+    @staticmethod
+    def cv2_preprocess(frame, input_size=(IMAGE_WIDTH, IMAGE_HEIGHT)):
         x = cv2.cvtColor(
-            cv2.resize(frame, (IMAGE_WIDTH, IMAGE_HEIGHT)),
+            cv2.resize(frame, tuple(input_size)),
             cv2.COLOR_BGR2RGB,
         ).transpose((2, 0, 1)).astype(np.float32) / 255.
         x -= IMAGE_MEAN
         x /= IMAGE_STDDEV
         return np.stack((x, np.flip(x, -1)))
 
+    def cv2_preprocess_batch(self, frames):
+        """Like ``cv2_preprocess`` at ``input_size``, for a batch of the normal and mirrored copies of each frame."""
+        if self.folded:
+            return np.stack([cv2.resize(frame, self.input_size) for frame in frames])
+        if len(frames) == 1:
+            return self.cv2_preprocess(frames[0], self.input_size)
+        return np.concatenate([self.cv2_preprocess(frame, self.input_size) for frame in frames])
+
+    def cv2_preprocess_into(self, frame, out):
+        """Like ``cv2_preprocess``, but fills ``out`` of ``input_shape`` without allocating."""
+        if self.folded:
+            resized, = out
+            if frame.shape[1::-1] == self.input_size:
+                np.copyto(resized, frame)
+            else:
+                cv2.resize(frame, self.input_size, dst=resized)
+            return out
+        if frame.shape[1::-1] == self.input_size:
+            resized = frame
+        else:
+            resized = cv2.resize(frame, self.input_size, dst=self._resized)
+        normal, mirrored = out
+        for channel in range(3):
+            # BGR to RGB and HWC to CHW by reading the source channel as a strided view
+            np.multiply(resized[:, :, 2 - channel], IMAGE_SCALE[channel], out=normal[channel])
+            np.subtract(normal[channel], IMAGE_OFFSET[channel], out=normal[channel])
+        np.copyto(mirrored, normal[..., ::-1])
+        return out
+
+    def cv2_preprocess_batch_into(self, frames, out):
+        for frame, pair in zip(frames, out.reshape(-1, *self.input_shape)):
+            self.cv2_preprocess_into(frame, pair)
+        return out
+
+    def cv2_preprocess_inplace(self, frame):
+        """Like ``cv2_preprocess_into`` the session's own buffer, overwritten by each call, so for a single thread."""
+        return self.cv2_preprocess_into(frame, self.input_buffer)
+
     def onnx_run(self, input):
-        return self.onnx_inference_session.run(['output'], {'input': input})
+        return self.onnx_inference_session.run(['output'], {self.input_name: input})
+
+    def onnx_run_into(self, input, out):
+        """Like ``onnx_run``, but binds ``input`` and ``out`` to the model without copying."""
+        if self._io_binding is None:
+            self._io_binding = self.onnx_inference_session.io_binding()
+        input = np.ascontiguousarray(input, dtype=self.input_dtype)
+        self._io_binding.bind_cpu_input(self.input_name, input)
+        self._io_binding.bind_output(
+            'output', 'cpu', 0, np.float32, out.shape, out.ctypes.data,
+        )
+        self.onnx_inference_session.run_with_iobinding(self._io_binding)
+        return [out]
 
     @staticmethod
     def postprocess(output):
         left, flipped_right = output[0]
-        return np.stack((left, np.flip(flipped_right, -1)))
+        return left, flipped_right[..., ::-1]
+
+    def postprocess_batch(self, output):
+        """Like ``postprocess``, for each frame of a batch from ``cv2_preprocess_batch``."""
+        output, = output
+        if self.folded:
+            return [(left, right) for left, right in output]
+        return [self.postprocess([pair]) for pair in output.reshape(-1, 2, *output.shape[1:])]
 
     def cv2_run(self, frame):
-        input = self.cv2_preprocess(frame)
+        input = self.cv2_preprocess_batch([frame])
         output = self.onnx_run(input)
-        return self.postprocess(output)
+        return self.postprocess_batch(output)[0]
+
+
+class IdleScheduler:
+    """Lowers the inference frame rate while no hand is in view.
+
+    After ``idle_after`` seconds without a hand score of at least ``detection_threshold``,
+    only ``idle_fps`` frames per second are inferred, until a score crosses ``wake_threshold``.
+    """
+
+    ACTIVE = 'active'
+    IDLE = 'idle'
+
+    def __init__(self, idle_after=10., idle_fps=4., detection_threshold=.5, wake_threshold=.3):
+        self.idle_after = idle_after
+        self.idle_fps = idle_fps
+        self.detection_threshold = detection_threshold
+        self.wake_threshold = wake_threshold
+        self.mode = self.ACTIVE
+        self.detected_at = None
+        self.processed_at = None
+
+    def should_process(self, at):
+        if self.mode == self.ACTIVE:
+            return True
+        if self.processed_at is None or at - self.processed_at >= 1 / self.idle_fps:
+            self.processed_at = at
+            return True
+        return False
+
+    def observe(self, at, score):
+        threshold = self.detection_threshold if self.mode == self.ACTIVE else self.wake_threshold
+        if self.detected_at is None or score >= threshold:
+            self.detected_at = at
+            self.mode = self.ACTIVE
+        elif at - self.detected_at > self.idle_after:
+            self.mode = self.IDLE
+
+
+class MotionGate:
+    """Tells if a frame changed enough since the last inferred one to infer it again.
+
+    Frames are compared downsampled to ``size``, by mean absolute difference relative to the full scale,
+    and at least every ``refresh_interval``-th frame is inferred anyway. ``reuse`` counts frames given
+    the last result instead, and ``inferred`` sets the frame compared with, once one is actually inferred.
+    """
+
+    def __init__(self, threshold=.02, refresh_interval=10, size=(32, 24)):
+        self.threshold = threshold
+        self.refresh_interval = refresh_interval
+        self.size = size
+        self.reference = None
+        self.reused = 0
+
+    def thumbnail(self, frame):
+        return cv2.cvtColor(cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+
+    def changed(self, frame):
+        if self.reference is None or self.reused + 1 >= self.refresh_interval:
+            return True
+        thumbnail = self.thumbnail(frame)
+        return cv2.norm(thumbnail, self.reference, cv2.NORM_L1) / (thumbnail.size * 255) >= self.threshold
+
+    def reuse(self):
+        self.reused += 1
+
+    def inferred(self, frame):
+        self.reference = self.thumbnail(frame)
+        self.reused = 0
+
+
+class FlowTracker:
+    """Moves the heatmaps of the last result along with sparse optical flow of the frames.
+
+    Corners are tracked inside each detected hand, and both of its heatmaps are shifted by their median displacement.
+    """
+
+    def __init__(self, detection_threshold=.5, max_corners=20):
+        self.detection_threshold = detection_threshold
+        self.max_corners = max_corners
+        self.frame = None
+        self.inference_result = None
+
+    def update(self, frame, inference_result):
+        self.frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.inference_result = inference_result
+
+    def propagate(self, frame):
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        inference_result = tuple(self.moved(hand, frame) for hand in self.inference_result)
+        self.frame, self.inference_result = frame, inference_result
+        return inference_result
+
+    def moved(self, hand, frame):
+        heatmap = hand[0]
+        if heatmap.max() <= self.detection_threshold:
+            return hand
+        height, width = frame.shape
+        mask = cv2.resize(
+            (heatmap > self.detection_threshold).astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST,
+        )
+        corners = cv2.goodFeaturesToTrack(self.frame, self.max_corners, .01, 3, mask=mask)
+        if corners is None:
+            return hand
+        tracked, status, _ = cv2.calcOpticalFlowPyrLK(self.frame, frame, corners, None)
+        found = status.ravel() == 1
+        if not found.any():
+            return hand
+        dx, dy = np.median((tracked - corners)[found], axis=0).ravel()
+        heatmap_height, heatmap_width = heatmap.shape
+        translation = np.float32([[1, 0, dx * heatmap_width / width], [0, 1, dy * heatmap_height / height]])
+        return np.stack([
+            cv2.warpAffine(np.ascontiguousarray(channel), translation, (heatmap_width, heatmap_height))
+            for channel in hand
+        ])
+
+
+BudgetSettings = collections.namedtuple('BudgetSettings', 'intra_op_num_threads frame_skip capture_size')
+
+
+class BudgetController:
+    """Steps through settings from the most to the least expensive, to keep CPU load and frame rate on target.
+
+    Every ``interval`` seconds, process CPU time per second is compared with ``max_cpu``, in cores,
+    and the frame rate with ``min_fps``. Settings get cheaper while over the CPU budget, or well above the frame rate,
+    and more expensive while below the frame rate, or well under the CPU budget, by a margin of ``headroom``.
+    """
+
+    def __init__(self, max_cpu=None, min_fps=None, interval=5., max_threads=None, max_frame_skip=4, headroom=.8):
+        self.max_cpu = max_cpu
+        self.min_fps = min_fps
+        self.interval = interval
+        self.headroom = headroom
+        thread_counts = [max_threads or os.cpu_count() or 1]
+        while thread_counts[-1] > 1:
+            thread_counts.append(thread_counts[-1] // 2)
+        self.levels = [
+            *(BudgetSettings(n, 1, (IMAGE_WIDTH, IMAGE_HEIGHT)) for n in thread_counts),
+            *(BudgetSettings(1, n, (IMAGE_WIDTH, IMAGE_HEIGHT)) for n in range(2, max_frame_skip + 1)),
+            BudgetSettings(1, max_frame_skip, (IMAGE_WIDTH // 2, IMAGE_HEIGHT // 2)),
+        ]
+        self.level = 0
+        self.frames = 0
+        self.measured_at = None
+        self.cpu_time = None
+        self.captured = 0
+
+    @property
+    def settings(self):
+        return self.levels[self.level]
+
+    def should_process(self):
+        self.captured += 1
+        return self.captured % self.settings.frame_skip == 0
+
+    def observe(self, at):
+        cpu_time = time.process_time()
+        if self.measured_at is None:
+            self.measured_at, self.cpu_time, self.frames = at, cpu_time, 0
+            return
+        self.frames += 1
+        elapsed = at - self.measured_at
+        if elapsed < self.interval:
+            return
+        cpu = (cpu_time - self.cpu_time) / elapsed
+        fps = self.frames / elapsed
+        self.measured_at, self.cpu_time, self.frames = at, cpu_time, 0
+        if self.max_cpu is not None and cpu > self.max_cpu:
+            step = 1
+        elif self.min_fps is not None and fps < self.min_fps:
+            step = -1 if self.max_cpu is None or cpu < self.max_cpu * self.headroom else 0
+        elif self.max_cpu is None:
+            step = 1 if fps * self.headroom > self.min_fps else 0
+        elif self.min_fps is None:
+            step = -1 if cpu < self.max_cpu * self.headroom else 0
+        else:
+            step = 0
+        level = min(max(self.level + step, 0), len(self.levels) - 1)
+        if level != self.level:
+            self.level = level
+            logger.info(f"CPU {cpu:.0%}, {fps:.1f} fps, switching to {self.settings}")
 
 
 class CvCameraInferencePipeline(Pipeline):
@@ -54,45 +703,312 @@ class CvCameraInferencePipeline(Pipeline):
             self.inference_result = None
             self.latency = None
             self.fps = None
+            self.mode = IdleScheduler.ACTIVE
+            self.reused = False
+            # with several cameras, frame and inference_result are those of the first
+            self.frames = None
+            self.inference_results = None
+            # left and right HandState of inference_result
+            self.hands = None
 
-    def __init__(self, camera=0, model_file=None):
+    def __init__(self, camera=0, model_file=None, preallocate=False, io_binding=False, session_options=None,
+                 inference_workers=1, scheduler=None, motion_gate=None, flow_tracker=None, budget=None,
+                 capture_options=None):
+        cameras = list(camera) if isinstance(camera, (list, tuple)) else [camera]
+        if len(cameras) > 1 and (motion_gate is not None or flow_tracker is not None):
+            raise ValueError("Motion gating and flow tracking support a single camera only")
+        if budget is not None:
+            session_options = {**(session_options or {}), 'intra_op_num_threads': budget.settings.intra_op_num_threads}
+        self.inference_sessions = [
+            InferenceSession(model_file, **(session_options or {}))
+            for _ in range(inference_workers)
+        ]
+        self.inference_session = self.inference_sessions[0]
+        self.inference_component = self.inference if inference_workers == 1 else Parallel([
+            functools.partial(self.inference, inference_session=inference_session)
+            for inference_session in self.inference_sessions
+        ], name='inference')
         components = [
             self.video_capture,
             self.preprocessing,
-            self.inference,
+            self.gated_inference if motion_gate is not None else self.inference_component,
             self.postprocessing,
         ]
-        super().__init__(components, default_input_factory=lambda: Factory(self.Item))
+        super().__init__(components, default_input_factory=self.item_factory)
+        # a camera index, or a FrameSource
         self.camera = camera
-        self.inference_session = InferenceSession(model_file)
+        # camera indices, inferred together as a batch of their normal and mirrored frames
+        self.cameras = cameras
+        self.capture_options = capture_options or {}
+        # preprocessing and postprocessing share it, so multiprocess runs are rejected
+        self.scheduler = scheduler
+        self.motion_gate = motion_gate
+        # moves reused results along with the frames, so the motion gate should infer every n-th frame at least
+        self.flow_tracker = flow_tracker
+        # like the scheduler, shared by capture, preprocessing, inference and postprocessing, so single process only
+        self.budget = budget
+        # held from preprocessing until inferred, by each inference worker and a frame waiting for it,
+        # while another is preprocessed, and with several workers, frames waiting for each
+        input_shape = self.inference_session.input_shape
+        self.input_buffers = BufferPool(
+            (input_shape[0] * len(cameras), *input_shape[1:]), self.inference_session.input_dtype,
+            size=2 + 2 * inference_workers,
+        ) if preallocate or io_binding else None
+        # with io_binding, results are views of one until no longer referenced, so enough for frames being
+        # inferred and passed on, the consumer's and the last result kept for reuse
+        output_shape = self.inference_session.output_shape
+        self.output_buffers = BufferPool(
+            (output_shape[0] * len(cameras), *output_shape[1:]), size=4 + 2 * inference_workers,
+        ) if io_binding else None
 
-    def video_capture(self, items):
-        capture = cv2.VideoCapture(self.camera)
+    def item_factory(self):
+        return Factory(self.Item)
+
+    @property
+    def unpaced(self):
+        return isinstance(self.camera, FrameSource) and not self.camera.realtime
+
+    def unpaced_channels(self):
+        """Queues between all stages, for every frame of an unpaced source to pass through."""
+        return {component.__name__: functools.partial(Queue, UNPACED_QUEUE) for component in self.components}
+
+    def threaded(self, input=None, log_interval=None, tracer=None, channels=None):
+        if channels is None and self.unpaced:
+            channels = self.unpaced_channels()
+        return super().threaded(input, log_interval, tracer, channels)
+
+    def multiprocess(self, input=None, processes=None):
+        if self.unpaced:
+            raise ValueError("Unpaced sources need queues between stages, which multiprocess runs don't have")
+        if self.scheduler is not None:
+            raise ValueError("The idle scheduler is shared by several stages, so it can't run in worker processes")
+        if self.budget is not None:
+            raise ValueError("The budget controller is shared by several stages, so it can't run in worker processes")
+        return super().multiprocess(input, processes)
+
+    def open_capture(self, camera):
+        capture = cv2.VideoCapture(camera, CAPTURE_BACKENDS[self.capture_options.get('backend') or 'any'])
+        if self.capture_options.get('fourcc'):
+            capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.capture_options['fourcc']))
+        if self.capture_options.get('buffer_size'):
+            capture.set(cv2.CAP_PROP_BUFFERSIZE, self.capture_options['buffer_size'])
         capture.set(cv2.CAP_PROP_FRAME_WIDTH, IMAGE_WIDTH)
         capture.set(cv2.CAP_PROP_FRAME_HEIGHT, IMAGE_HEIGHT)
-        for item in items:
-            item.captured_at = time.time()
-            returned, item.frame = capture.read()
-            if not returned:
-                break
-            yield item
-        capture.release()
+        return capture
+
+    @staticmethod
+    def read(capture):
+        grabbed = capture.grab()
+        grabbed_at = time.monotonic()
+        if not grabbed:
+            return False, None, None
+        retrieved, frame = capture.retrieve()
+        return retrieved, grabbed_at, frame
+
+    def video_capture(self, items):
+        if isinstance(self.camera, FrameSource):
+            for item in self.camera.capture(items):
+                item.frames = [item.frame]
+                yield item
+            return
+        captures = [self.open_capture(camera) for camera in self.cameras]
+        # several cameras are grabbed from in parallel
+        if self.capture_options.get('grab_thread') or len(captures) > 1:
+            grabbers = [FrameGrabber(capture) for capture in captures]
+        else:
+            grabbers = []
+        capture_size = (IMAGE_WIDTH, IMAGE_HEIGHT)
+        try:
+            for item in items:
+                if self.budget is not None and self.budget.settings.capture_size != capture_size:
+                    capture_size = self.budget.settings.capture_size
+                    for configurable in grabbers or captures:
+                        configurable.set(cv2.CAP_PROP_FRAME_WIDTH, capture_size[0])
+                        configurable.set(cv2.CAP_PROP_FRAME_HEIGHT, capture_size[1])
+                for grabber in grabbers:
+                    grabber.request()
+                reads = [grabber.wait() for grabber in grabbers] if grabbers else [self.read(captures[0])]
+                returned, grabbed_at, frames = zip(*reads)
+                if not all(returned):
+                    break
+                item.captured_at = min(grabbed_at)
+                item.frames = list(frames)
+                item.frame = item.frames[0]
+                yield item
+        finally:
+            for grabber in grabbers:
+                grabber.close()
+            for capture in captures:
+                capture.release()
 
     def preprocessing(self, items):
         for item in items:
-            item.preprocessed = self.inference_session.cv2_preprocess(item.frame)
+            if self.scheduler is not None:
+                if not self.scheduler.should_process(item.captured_at):
+                    continue
+                item.mode = self.scheduler.mode
+            if self.budget is not None and not self.budget.should_process():
+                continue
+            if self.input_buffers is None:
+                item.preprocessed = self.inference_session.cv2_preprocess_batch(item.frames)
+            else:
+                # waits for a buffer while all are in use, as newer frames replace this one in latest-value channels
+                buffer = self.input_buffers.acquire(item)
+                item.preprocessed = self.inference_session.cv2_preprocess_batch_into(item.frames, buffer)
             yield item
 
-    def inference(self, items):
+    def gated_inference(self, items):
+        """Infers frames the motion gate lets through, and passes the others on right away with the last result.
+
+        The model runs on a thread of its own, so frames reusing its last result don't wait behind it, and with
+        a flow tracker, it moves that result along with them here as well.
+        A frame being inferred when a newer one comes is passed on first, as a copy with the last result,
+        and its own result is reused from when it's ready.
+        """
+        workers = len(self.inference_sessions)
+        submitted = Queue(workers)
+        condition = threading.Condition()
+        captured = collections.deque()
+        inferred = collections.deque()
+        state = {'captured': False, 'inferred': False, 'closing': False}
+
+        def capture():
+            try:
+                for item in items:
+                    with condition:
+                        captured.append(item)
+                        condition.notify_all()
+                        condition.wait_for(lambda: not captured or state['closing'])
+                        if state['closing']:
+                            return
+            finally:
+                with condition:
+                    state['captured'] = True
+                    condition.notify_all()
+
+        def infer():
+            try:
+                for item in self.inference_component(submitted):
+                    with condition:
+                        inferred.append(item)
+                        condition.notify_all()
+            finally:
+                with condition:
+                    state['inferred'] = True
+                    condition.notify_all()
+
+        threads = [
+            threading.Thread(target=capture, daemon=True, name='inference-capture'),
+            threading.Thread(target=infer, daemon=True, name='inference-model'),
+        ]
+        for thread in threads:
+            thread.start()
+        in_flight = {}
+        waiting_items = {}
+        sequence = 0
+        passed_on = -1
+        last_inference_results = None
+        try:
+            while True:
+                with condition:
+                    condition.wait_for(lambda: inferred or captured or state['captured'] or state['inferred'])
+                    if inferred:
+                        item = inferred.popleft()
+                        item_sequence = in_flight.pop(id(item))
+                        del waiting_items[id(item)]
+                    elif captured:
+                        item = captured.popleft()
+                        item_sequence = None
+                        condition.notify_all()
+                    elif not in_flight or state['inferred']:
+                        return
+                    else:
+                        condition.wait()
+                        continue
+                if item_sequence is not None:
+                    item.inference_results = self.inference_session.postprocess_batch(item.raw_inference_result)
+                    self.motion_gate.inferred(item.frame)
+                    if self.flow_tracker is not None:
+                        self.flow_tracker.update(item.frame, item.inference_results[0])
+                    last_inference_results = item.inference_results
+                    if item_sequence > passed_on:
+                        passed_on = item_sequence
+                        yield item
+                    continue
+                sequence += 1
+                if last_inference_results is not None:
+                    for key, waiting_sequence in list(in_flight.items()):
+                        if waiting_sequence > passed_on:
+                            # a copy, as the item itself is still being inferred
+                            waiting = copy.copy(waiting_items[key])
+                            waiting.preprocessed = None
+                            waiting.reused = True
+                            waiting.inference_results = self.reused_inference_results(waiting, last_inference_results)
+                            passed_on = waiting_sequence
+                            yield waiting
+                if last_inference_results is None or self.motion_gate.changed(item.frame):
+                    if len(in_flight) < workers:
+                        in_flight[id(item)] = sequence
+                        waiting_items[id(item)] = item
+                        submitted.update(item)
+                        continue
+                    if last_inference_results is None:
+                        self.release_preprocessed(item)
+                        continue
+                self.motion_gate.reuse()
+                self.release_preprocessed(item)
+                item.reused = True
+                item.inference_results = self.reused_inference_results(item, last_inference_results)
+                passed_on = sequence
+                yield item
+        finally:
+            with condition:
+                state['closing'] = True
+                condition.notify_all()
+            submitted.discard()
+
+    def reused_inference_results(self, item, last_inference_results):
+        if self.flow_tracker is None:
+            return last_inference_results
+        return [self.flow_tracker.propagate(item.frame)]
+
+    def inference(self, items, inference_session=None):
+        inference_session = inference_session or self.inference_session
         for item in items:
-            item.raw_inference_result = self.inference_session.onnx_run(item.preprocessed)
+            if self.budget is not None and self.budget.settings.intra_op_num_threads != inference_session.arguments[1]:
+                model_file, _, *arguments = inference_session.arguments
+                inference_session = InferenceSession(model_file, self.budget.settings.intra_op_num_threads, *arguments)
+            if self.output_buffers is None:
+                item.raw_inference_result = inference_session.onnx_run(item.preprocessed)
+            else:
+                # heatmaps are views of the buffer, so it's held while any are, and when all are, outputs are allocated
+                buffer = self.output_buffers.lend(timeout=0)
+                if buffer is None:
+                    item.raw_inference_result = inference_session.onnx_run(item.preprocessed)
+                else:
+                    item.raw_inference_result = inference_session.onnx_run_into(item.preprocessed, buffer)
+            self.release_preprocessed(item)
             yield item
 
+    def release_preprocessed(self, item):
+        if self.input_buffers is not None:
+            self.input_buffers.release(item)
+            item.preprocessed = None
+
     def postprocessing(self, items):
-        last_time = time.time()
+        last_time = time.monotonic()
         for item in items:
-            item.inference_result = self.inference_session.postprocess(item.raw_inference_result)
-            now = time.time()
+            if item.inference_results is None:
+                item.inference_results = self.inference_session.postprocess_batch(item.raw_inference_result)
+            item.inference_result = item.inference_results[0]
+            item.hands = hand_states(item.inference_result)
+            if self.scheduler is not None:
+                self.scheduler.observe(item.captured_at, max(
+                    max(left.max(), right.max()) for (left, _), (right, _) in item.inference_results
+                ))
+            now = time.monotonic()
+            if self.budget is not None:
+                self.budget.observe(now)
             item.fps = 1 / (now - last_time)
             item.latency = now - item.captured_at
             yield item
@@ -1,5 +1,9 @@
+import collections
+
 import numpy as np
 
+HandState = collections.namedtuple('HandState', 'score x y openness')
+
 
 def relative_average_coordinate(heatmap, axis, weight_exponent=4):
     if isinstance(axis, tuple):
@@ -14,6 +18,29 @@ def relative_average_coordinate(heatmap, axis, weight_exponent=4):
     return (value * weights).sum() / weights.sum()
 
 
+def hand_states(inference_result, threshold=.5, weight_exponent=4):
+    """Returns the left and right hand ``HandState``, computed for both at once.
+
+    Scores are heatmap maxima, coordinates are like ``relative_average_coordinate``
+    and openness is averaged where the heatmap exceeds ``threshold``.
+    """
+    heatmaps, openness = np.stack(inference_result).transpose((1, 0, 2, 3))
+    coordinates = []
+    for other in (1, 2):
+        weights = heatmaps.sum(axis=other) ** weight_exponent
+        value, step = np.linspace(0, 1, weights.shape[1], endpoint=False, retstep=True)
+        value += step / 2
+        total = weights.sum(axis=1)
+        coordinates.append(np.divide(weights @ value, total, out=np.full(len(total), .5), where=total > 0))
+    mask = heatmaps > threshold
+    count = mask.sum(axis=(1, 2))
+    openness = np.divide((openness * mask).sum(axis=(1, 2)), count, out=np.zeros(len(count)), where=count > 0)
+    return tuple(
+        HandState(float(score), float(x), float(y), float(o))
+        for score, x, y, o in zip(heatmaps.max(axis=(1, 2)), *coordinates, openness)
+    )
+
+
 def accumulate(accumulated, current, accumulated_weight=1):
     if accumulated is None:
         return current
@@ -1,4 +1,23 @@
+import asyncio
+import collections
+import copy
+import itertools
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
 import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_END = object()
 
 
 class ClosableIterable:
@@ -6,15 +25,76 @@ class ClosableIterable:
     def __init__(self):
         self.condition = threading.Condition()
         self.closed = False
+        self.listeners = []
+        self.consumed = 0
+        self.skipped = 0
+        self.waiting_time = 0.
+        self.blocking_time = 0.
+
+    def notify(self):
+        self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
 
     def close(self):
         with self.condition:
             self.closed = True
-            self.condition.notify_all()
+            self.notify()
 
-    def __iter__(self):
+    def discard(self):
+        """Closes, dropping values not taken yet, as when the consumer is gone."""
+        self.close()
+
+    @property
+    def depth(self):
+        return 0
+
+    def take(self):
+        """Returns ``(True, value)`` for the next value, if there is one yet, otherwise ``(False, None)``.
+
+        Must be called holding ``condition``.
+        """
         raise NotImplementedError()
 
+    def __iter__(self):
+        while True:
+            with self.condition:
+                waiting_since = time.perf_counter()
+                available, value = self.take()
+                while not available and not self.closed:
+                    self.condition.wait()
+                    available, value = self.take()
+                self.waiting_time += time.perf_counter() - waiting_since
+                if not available:
+                    return
+            yield value
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+
+        def listener():
+            loop.call_soon_threadsafe(event.set)
+
+        with self.condition:
+            self.listeners.append(listener)
+        try:
+            while True:
+                event.clear()
+                with self.condition:
+                    available, value = self.take()
+                    if not available and self.closed:
+                        return
+                if available:
+                    yield value
+                else:
+                    waiting_since = time.perf_counter()
+                    await event.wait()
+                    self.waiting_time += time.perf_counter() - waiting_since
+        finally:
+            with self.condition:
+                self.listeners.remove(listener)
+
 
 class Factory(ClosableIterable):
 
@@ -27,46 +107,348 @@ class Factory(ClosableIterable):
             with self.condition:
                 if self.closed:
                     return
+                self.consumed += 1
             yield self.callback()
 
 
 class Updatable(ClosableIterable):
+    """Keeps only the latest value, so a slow consumer skips older ones."""
 
     def __init__(self):
         super().__init__()
         self.version = 0
         self.value = None
+        self.read_version = 0
 
     def update(self, value):
         with self.condition:
             self.version += 1
             self.value = value
-            self.condition.notify_all()
+            self.notify()
 
-    def __iter__(self):
-        previous = 0
-        while True:
-            with self.condition:
-                while not self.closed and self.version == previous:
+    def discard(self):
+        with self.condition:
+            self.read_version = self.version
+            self.value = None
+        self.close()
+
+    @property
+    def depth(self):
+        return int(self.version != self.read_version)
+
+    def take(self):
+        if self.version == self.read_version:
+            return False, None
+        self.consumed += 1
+        self.skipped += self.version - self.read_version - 1
+        self.read_version = self.version
+        return True, self.value
+
+
+class Queue(ClosableIterable):
+    """Keeps up to ``maxsize`` values in order.
+
+    When full, ``update`` blocks until there is room, or drops the oldest value if ``drop_oldest``.
+    Once closed, as when a run exits, ``update`` drops the value instead of waiting.
+    """
+
+    def __init__(self, maxsize, drop_oldest=False):
+        super().__init__()
+        self.values = collections.deque()
+        self.maxsize = maxsize
+        self.drop_oldest = drop_oldest
+
+    def update(self, value):
+        with self.condition:
+            if self.drop_oldest:
+                if len(self.values) >= self.maxsize:
+                    self.values.popleft()
+                    self.skipped += 1
+            else:
+                blocking_since = time.perf_counter()
+                while not self.closed and len(self.values) >= self.maxsize:
                     self.condition.wait()
-                if self.closed:
-                    return
-                value = self.value
-                previous = self.version
-            yield value
-            
-            
+                self.blocking_time += time.perf_counter() - blocking_since
+            if self.closed:
+                return
+            self.values.append(value)
+            self.notify()
+
+    def discard(self):
+        with self.condition:
+            self.values.clear()
+        self.close()
+
+    @property
+    def depth(self):
+        return len(self.values)
+
+    def take(self):
+        if not self.values:
+            return False, None
+        self.consumed += 1
+        value = self.values.popleft()
+        self.condition.notify_all()
+        return True, value
+
+
+class Broadcast(Updatable):
+    """An ``Updatable`` also passing its values on to subscribed channels.
+
+    Subscribers get their own ``Updatable`` or ``Queue(..., drop_oldest=True)``,
+    so a slow one can't hold up the producer.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.subscribers = []
+
+    def subscribe(self, channel=None):
+        channel = Updatable() if channel is None else channel
+        if isinstance(channel, Queue) and not channel.drop_oldest:
+            raise ValueError("Blocking queues would let a subscriber hold up the producer")
+        with self.condition:
+            if self.closed:
+                channel.close()
+            self.subscribers.append(channel)
+        return channel
+
+    def unsubscribe(self, channel):
+        with self.condition:
+            self.subscribers.remove(channel)
+
+    def update(self, value):
+        with self.condition:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.update(value)
+        super().update(value)
+
+    def close(self):
+        with self.condition:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.close()
+        super().close()
+
+
+class Parallel:
+    """A component running several equivalent components in threads, each on inputs given to it when idle.
+
+    An input is taken only once a component is idle, so sequential runs and queues pass every one on,
+    and in threaded runs, the channel before the stage keeps replacing it with the latest one meanwhile.
+    Outputs come in input order if ``ordered``, skipping inputs a component dropped,
+    otherwise each output is passed on as soon as it is newer than the previous one.
+    """
+
+    def __init__(self, components, name, ordered=True):
+        self.components = components
+        self.__name__ = name
+        self.ordered = ordered
+
+    def __call__(self, items):
+        workers = len(self.components)
+        inputs = [Queue(1) for _ in self.components]
+        condition = threading.Condition()
+        state = {'dispatched': 0, 'done': False, 'closing': False}
+        idle = list(range(workers))
+        results = {}
+        dropped = set()
+        pulled = [None] * workers
+        finished = [False] * workers
+
+        def dispatch():
+            try:
+                for sequence in itertools.count():
+                    with condition:
+                        condition.wait_for(lambda: idle or state['closing'])
+                        if state['closing']:
+                            return
+                        worker = idle.pop(0)
+                    item = next(iterator, _END)
+                    if item is _END:
+                        return
+                    with condition:
+                        state['dispatched'] = sequence + 1
+                    inputs[worker].update((sequence, item))
+            finally:
+                for input in inputs:
+                    input.close()
+                with condition:
+                    state['done'] = True
+                    condition.notify_all()
+
+        def work(worker):
+            def pulled_items():
+                for sequence, item in inputs[worker]:
+                    with condition:
+                        pulled[worker] = sequence
+                    yield item
+                    # each component handles its inputs one by one, so it's done with one when it asks for another
+                    with condition:
+                        if sequence not in results:
+                            dropped.add(sequence)
+                        pulled[worker] = None
+                        idle.append(worker)
+                        condition.notify_all()
+            try:
+                for value in self.components[worker](pulled_items()):
+                    with condition:
+                        results[pulled[worker]] = value
+                        condition.notify_all()
+            finally:
+                with condition:
+                    if pulled[worker] is not None and pulled[worker] not in results:
+                        dropped.add(pulled[worker])
+                    finished[worker] = True
+                    condition.notify_all()
+
+        iterator = iter(items)
+        threads = [threading.Thread(target=dispatch, daemon=True, name=f'{self.__name__}-dispatch')]
+        threads.extend(
+            threading.Thread(target=work, args=(worker,), daemon=True, name=f'{self.__name__}-{worker}')
+            for worker in range(workers)
+        )
+        for thread in threads:
+            thread.start()
+        next_sequence = 0
+        try:
+            while True:
+                with condition:
+                    while True:
+                        for stale in [s for s in results if s < next_sequence]:
+                            del results[stale]
+                        dropped.difference_update([s for s in dropped if s < next_sequence])
+                        if self.ordered and next_sequence in results:
+                            sequence = next_sequence
+                            break
+                        if not self.ordered and results:
+                            sequence = max(results)
+                            break
+                        if self.ordered and next_sequence in dropped:
+                            dropped.discard(next_sequence)
+                            next_sequence += 1
+                            continue
+                        if state['done'] and all(finished) and not results:
+                            return
+                        condition.wait()
+                    value = results.pop(sequence)
+                    next_sequence = sequence + 1
+                yield value
+        finally:
+            with condition:
+                state['closing'] = True
+                condition.notify_all()
+            for input in inputs:
+                input.discard()
+
+
+class Tracer:
+    """Records spans of component invocations per item, as Chrome trace events viewable in Perfetto.
+
+    Only the last ``max_events`` spans are kept, so it can be left on for a while.
+    """
+
+    def __init__(self, max_events=100000):
+        self.events = collections.deque(maxlen=max_events)
+        self.thread_names = {}
+
+    @staticmethod
+    def clock():
+        return time.perf_counter() * 1e6
+
+    def record(self, name, item, started, ended):
+        thread = threading.current_thread()
+        if thread.ident not in self.thread_names:
+            self.thread_names[thread.ident] = thread.name
+        self.events.append((name, id(item), thread.ident, started, ended - started))
+
+    def traced(self, component, max_pending=1000):
+        """Wraps a component to record a span from receiving each item to yielding it.
+
+        Components may take several items before yielding one, so receive times are kept per item.
+        Items the component drops are forgotten once ``max_pending`` newer ones were received.
+        """
+        name = component.__name__
+        received_at = {}
+        lock = threading.Lock()
+
+        def received(items):
+            for item in items:
+                with lock:
+                    received_at[id(item)] = self.clock()
+                    if len(received_at) > max_pending:
+                        del received_at[next(iter(received_at))]
+                yield item
+
+        def wrapper(items):
+            for item in component(received(items)):
+                with lock:
+                    started = received_at.pop(id(item), None)
+                if started is not None:
+                    self.record(name, item, started, self.clock())
+                yield item
+
+        wrapper.__name__ = name
+        return wrapper
+
+    def trace_events(self):
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': name}}
+            for tid, name in list(self.thread_names.items())
+        ]
+        events.extend(
+            {'name': name, 'ph': 'X', 'pid': 0, 'tid': tid, 'ts': ts, 'dur': dur, 'args': {'item': item}}
+            for name, item, tid, ts, dur in list(self.events)
+        )
+        return events
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms'}, f)
+
+
 class Pipeline:
-    
+
     def __init__(self, components, default_input_factory=None):
         self.components = components
         self.default_input_factory = default_input_factory
 
-    def sequential(self, input=None):
-        return SequentialPipelineRun(input or self.default_input_factory(), self.components)
+    def run_components(self, tracer=None):
+        if tracer is None:
+            return self.components
+        return [tracer.traced(component) for component in self.components]
+
+    def run_async(self, input=None, log_interval=None, tracer=None, channels=None):
+        """Like ``threaded``, but for ``async with`` and ``async for``, without blocking the event loop."""
+        return AsyncPipelineRun(
+            input or self.default_input_factory(), self.run_components(tracer),
+            log_interval=log_interval, channels=channels,
+        )
+
+    def sequential(self, input=None, tracer=None):
+        return SequentialPipelineRun(input or self.default_input_factory(), self.run_components(tracer))
+
+    def threaded(self, input=None, log_interval=None, tracer=None, channels=None):
+        """Runs each component in its own thread.
 
-    def threaded(self, input=None):
-        return ThreadedPipelineRun(input or self.default_input_factory(), self.components)
+        Components pass values on through ``Updatable`` unless ``channels`` maps their name
+        to a factory of another channel, like ``lambda: Queue(10)``.
+        """
+        return ThreadedPipelineRun(
+            input or self.default_input_factory(), self.run_components(tracer),
+            log_interval=log_interval, channels=channels,
+        )
+
+    def multiprocess(self, input=None, processes=None):
+        """Like ``threaded``, but runs components named in ``processes`` in worker processes.
+
+        By default all components but the first, which reads the run's input, run in processes.
+        Components are pickled, so the pipeline has to be picklable.
+        """
+        if processes is None:
+            processes = [component.__name__ for component in self.components[1:]]
+        return MultiprocessPipelineRun(input or self.default_input_factory(), self.components, processes)
 
 
 class PipelineRun:
@@ -97,28 +479,350 @@ class ThreadedPipelineRun(PipelineRun):
 
     class Thread(threading.Thread):
 
-        def __init__(self, component, input):
+        def __init__(self, component, input, output=None):
             super().__init__(daemon=True, name=component.__name__)
             self.component = component
             self.input = input
-            self.output = Updatable()
+            self.output = Updatable() if output is None else output
+            self.busy_time = 0.
 
         def run(self):
             try:
-                for value in self.component(self.input):
+                values = iter(self.component(self.input))
+                while True:
+                    started = time.perf_counter()
+                    waiting_before = self.input.waiting_time
+                    try:
+                        value = next(values)
+                    except StopIteration:
+                        return
+                    finally:
+                        self.busy_time += time.perf_counter() - started - (self.input.waiting_time - waiting_before)
                     self.output.update(value)
             finally:
                 self.output.close()
 
-    def __init__(self, input: ClosableIterable, components):
+    class MetricsLogger(threading.Thread):
+
+        def __init__(self, pipeline_run, interval):
+            super().__init__(daemon=True, name='metrics')
+            self.pipeline_run = pipeline_run
+            self.interval = interval
+            self.stopped = threading.Event()
+
+        def run(self):
+            previous = self.pipeline_run.metrics()
+            while not self.stopped.wait(self.interval):
+                current = self.pipeline_run.metrics()
+                logger.info(' | '.join(
+                    self.format(now, before) for now, before in zip(current, previous)
+                ))
+                previous = current
+
+        def format(self, now, before):
+            consumed = now['consumed'] - before['consumed']
+            skipped = now['skipped'] - before['skipped']
+            waiting = (now['waiting_time'] - before['waiting_time']) / self.interval
+            line = f"{now['name']}: {consumed / self.interval:.1f}/s, {skipped} skipped, {now['depth']} queued, " \
+                   f"{waiting:.0%} waiting"
+            if now['busy_time'] is not None:
+                line += f", {(now['busy_time'] - before['busy_time']) / self.interval:.0%} busy"
+            return line
+
+    def __init__(self, input: ClosableIterable, components, log_interval=None, channels=None):
         super().__init__(input)
+        channels = channels or {}
         self.threads = []
-        for component in components:
-            thread = ThreadedPipelineRun.Thread(component, input=self.output)
+        for ix, component in enumerate(components):
+            channel = channels.get(component.__name__, Broadcast if ix == len(components) - 1 else Updatable)
+            thread = ThreadedPipelineRun.Thread(component, input=self.output, output=channel())
             self.output = thread.output
             self.threads.append(thread)
+        self.metrics_logger = None if log_interval is None else ThreadedPipelineRun.MetricsLogger(self, log_interval)
+
+    def subscribe(self, channel=None):
+        """Another view of the run's output, for a consumer in another thread.
+
+        The output must be a ``Broadcast``, as it is unless ``channels`` replaced it.
+        """
+        return self.output.subscribe(channel)
+
+    def metrics(self):
+        """Snapshot of each stage's input consumption and the time its thread spent in the component.
+
+        ``skipped`` counts values a stage never saw, because a newer one replaced them first,
+        ``depth`` is the number of values waiting for it and ``blocking_time`` the time the previous stage
+        spent waiting for room in a full queue. The last entry describes the consumer of the run's output.
+        """
+        stages = [(thread.name, thread.input, thread.busy_time) for thread in self.threads]
+        stages.append(('output', self.output, None))
+        return [
+            {
+                'name': name,
+                'consumed': input.consumed,
+                'skipped': input.skipped,
+                'waiting_time': input.waiting_time,
+                'blocking_time': input.blocking_time,
+                'depth': input.depth,
+                'busy_time': busy_time,
+            }
+            for name, input, busy_time in stages
+        ]
+
+    def __enter__(self):
+        for thread in self.threads:
+            thread.start()
+        if self.metrics_logger is not None:
+            self.metrics_logger.start()
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        super().__exit__(*exc_info)
+        if self.metrics_logger is not None:
+            self.metrics_logger.stopped.set()
+        # stages stop once their input is closed, and ones blocked on a full queue once their output is
+        for thread in self.threads:
+            thread.output.discard()
+        for thread in self.threads:
+            thread.join()
+
+
+class AsyncPipelineRun(ThreadedPipelineRun):
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.__exit__, *exc_info)
+
+    def __aiter__(self):
+        return self.output.__aiter__()
+
+
+ArrayRef = collections.namedtuple('ArrayRef', 'index')
+
+
+class SharedMemoryChannel:
+    """Latest-value channel to another process, moving arrays through a shared-memory ring buffer.
+
+    Values are sent with ``update`` and ``close`` in one process and iterated over in another, like ``Updatable``.
+    NumPy arrays in values, their attributes, lists and tuples are copied to one of ``slots`` slots
+    of a memory-mapped file instead of being pickled. A value whose slot got overwritten before it was read
+    is skipped, like one replaced in ``Updatable``.
+
+    Messages go through a new pipe, unless a ``connection`` to another process is given,
+    like one from ``multiprocessing.connection.Listener``. Then the other side should be created
+    with ``connection`` and ``handshake()`` of this side.
+    """
+
+    ALIGNMENT = 64
+
+    def __init__(self, slots=4, connection=None, path=None):
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='gest-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+            os.close(fd)
+        self.path = path
+        self.slots = slots
+        self.header_size = self.aligned(8 * slots)
+        if os.path.getsize(self.path) < self.header_size:
+            os.truncate(self.path, self.header_size)
+        if connection is None:
+            self.receiver, self.sender = multiprocessing.Pipe(duplex=False)
+        else:
+            self.receiver = self.sender = connection
+        self.slot_size = 0
+        self.next_slot = 0
+        self.memory = None
+        self.updatable = None
+        self.receiver_thread = None
+
+    def handshake(self):
+        return {'slots': self.slots, 'path': self.path}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memory'] = None
+        state['updatable'] = None
+        state['receiver_thread'] = None
+        return state
+
+    @classmethod
+    def aligned(cls, size):
+        return -(-size // cls.ALIGNMENT) * cls.ALIGNMENT
+
+    def map(self, size):
+        if self.memory is None or len(self.memory) < size:
+            with open(self.path, 'r+b') as f:
+                self.memory = mmap.mmap(f.fileno(), size)
+        return self.memory
+
+    def generations(self):
+        return np.frombuffer(self.map(self.header_size), dtype=np.int64, count=self.slots)
+
+    @classmethod
+    def export(cls, value, arrays):
+        if isinstance(value, np.ndarray):
+            # arrays referenced several times, like a frame also in a list of frames, are sent once
+            for index, array in enumerate(arrays):
+                if array is value:
+                    return ArrayRef(index)
+            arrays.append(value)
+            return ArrayRef(len(arrays) - 1)
+        if type(value) in (list, tuple):
+            return type(value)(cls.export(v, arrays) for v in value)
+        if hasattr(value, '__dict__') and not isinstance(value, type) and not callable(value):
+            exported = copy.copy(value)
+            for name, attribute in vars(value).items():
+                setattr(exported, name, cls.export(attribute, arrays))
+            return exported
+        return value
+
+    @classmethod
+    def restore(cls, value, arrays):
+        if isinstance(value, ArrayRef):
+            return arrays[value.index]
+        if type(value) in (list, tuple):
+            return type(value)(cls.restore(v, arrays) for v in value)
+        if hasattr(value, '__dict__') and not isinstance(value, type) and not callable(value):
+            for name, attribute in vars(value).items():
+                setattr(value, name, cls.restore(attribute, arrays))
+        return value
+
+    def update(self, value):
+        arrays = []
+        exported = self.export(value, arrays)
+        layout = []
+        size = 0
+        for array in arrays:
+            layout.append((size, array.shape, array.dtype.str))
+            size = self.aligned(size + array.nbytes)
+        generations = self.generations()
+        if size > self.slot_size:
+            generations += 2  # invalidates values in flight, before slots move
+            self.slot_size = size
+            os.truncate(self.path, self.header_size + self.slots * self.slot_size)
+        memory = self.map(self.header_size + self.slots * self.slot_size)
+        generations = self.generations()
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.slots
+        base = self.header_size + slot * self.slot_size
+        generations[slot] += 1
+        for array, (offset, shape, dtype) in zip(arrays, layout):
+            np.copyto(np.ndarray(shape, dtype, buffer=memory, offset=base + offset), array)
+        generations[slot] += 1
+        self.sender.send((exported, layout, slot, int(generations[slot]), self.slot_size))
+
+    def close(self):
+        self.sender.send(None)
+
+    def receive(self):
+        try:
+            while True:
+                try:
+                    message = self.receiver.recv()
+                except (EOFError, OSError):
+                    return
+                if message is None:
+                    return
+                self.updatable.update(message)
+        finally:
+            self.updatable.close()
+
+    def read(self, message):
+        exported, layout, slot, generation, slot_size = message
+        memory = self.map(self.header_size + self.slots * slot_size)
+        base = self.header_size + slot * slot_size
+        arrays = [
+            np.ndarray(shape, dtype, buffer=memory, offset=base + offset).copy()
+            for offset, shape, dtype in layout
+        ]
+        if self.generations()[slot] != generation:
+            return None
+        return self.restore(exported, arrays)
+
+    @property
+    def consumed(self):
+        return 0 if self.updatable is None else self.updatable.consumed
+
+    @property
+    def skipped(self):
+        return 0 if self.updatable is None else self.updatable.skipped
+
+    @property
+    def waiting_time(self):
+        return 0. if self.updatable is None else self.updatable.waiting_time
+
+    @property
+    def blocking_time(self):
+        return 0.
+
+    @property
+    def depth(self):
+        return 0 if self.updatable is None else self.updatable.depth
+
+    def disconnect(self):
+        """Stops receiving through a socket ``connection`` and closes it."""
+        with socket.fromfd(self.receiver.fileno(), socket.AF_UNIX, socket.SOCK_STREAM) as connected:
+            connected.shutdown(socket.SHUT_RDWR)
+        if self.receiver_thread is not None:
+            self.receiver_thread.join()
+        self.receiver.close()
+
+    def __iter__(self):
+        self.updatable = Updatable()
+        self.receiver_thread = threading.Thread(target=self.receive, daemon=True, name='receiver')
+        self.receiver_thread.start()
+        for message in self.updatable:
+            value = self.read(message)
+            if value is None:
+                with self.updatable.condition:
+                    self.updatable.skipped += 1
+                continue
+            yield value
+
+    def unlink(self):
+        os.unlink(self.path)
+
+
+def run_in_process(component, input, output):
+    # Ctrl-C reaches the whole process group, and the main process stops the run
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        for value in component(input):
+            output.update(value)
+    finally:
+        output.close()
+
+
+class MultiprocessPipelineRun(PipelineRun):
+
+    def __init__(self, input: ClosableIterable, components, processes):
+        super().__init__(input)
+        if components and components[0].__name__ in processes:
+            raise ValueError(f"{components[0].__name__} reads the run's input, so it has to run in this process")
+        context = multiprocessing.get_context('spawn')
+        self.threads = []
+        self.processes = []
+        self.channels = []
+        for ix, component in enumerate(components):
+            in_process = component.__name__ in processes
+            if in_process or (ix + 1 < len(components) and components[ix + 1].__name__ in processes):
+                output = SharedMemoryChannel()
+                self.channels.append(output)
+            else:
+                output = Updatable()
+            if in_process:
+                self.processes.append(context.Process(
+                    target=run_in_process, args=(component, self.output, output),
+                    daemon=True, name=component.__name__,
+                ))
+            else:
+                self.threads.append(ThreadedPipelineRun.Thread(component, input=self.output, output=output))
+            self.output = output
 
     def __enter__(self):
+        for process in self.processes:
+            process.start()
         for thread in self.threads:
             thread.start()
         return super().__enter__()
@@ -127,3 +831,9 @@ class ThreadedPipelineRun(PipelineRun):
         super().__exit__(*exc_info)
         for thread in self.threads:
             thread.join()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for channel in self.channels:
+            channel.unlink()
@@ -0,0 +1,102 @@
+import argparse
+import pathlib
+import random
+import tempfile
+
+from onnxruntime import quantization
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+from gest.annotation.gesture import annotated_gesture_managers
+from gest.inference import DEFAULT_MODEL_FILE, InferenceSession
+
+parser = argparse.ArgumentParser()
+parser.add_argument("output", help="Quantized model file")
+parser.add_argument("--model", help="Model file")
+parser.add_argument("--mode", help="Quantization mode", choices=('dynamic', 'static'), default='dynamic')
+parser.add_argument("--data-path", help="Annotated data path for static calibration")
+parser.add_argument("--samples", help="Number of calibration frames", type=int, default=200)
+parser.add_argument("--per-channel", help="Quantize weights per channel", action="store_true")
+
+
+def calibration_frames(data_path):
+    for manager in annotated_gesture_managers(data_path).values():
+        for saved in manager.saved():
+            annotated = saved.load()
+            if hasattr(annotated, 'frames'):
+                yield from annotated.frames
+            else:
+                yield annotated.frame
+
+
+def sampled(iterable, samples):
+    """Picks ``samples`` items at random, holding no more than that many at a time."""
+    sample = []
+    for index, item in enumerate(iterable):
+        if index < samples:
+            sample.append(item)
+        else:
+            replaced = random.randrange(index + 1)
+            if replaced < samples:
+                sample[replaced] = item
+    random.shuffle(sample)
+    return sample
+
+
+class CalibrationDataReader(quantization.CalibrationDataReader):
+
+    def __init__(self, data_path, samples):
+        frames = sampled(calibration_frames(data_path), samples)
+        if not frames:
+            raise ValueError(f"No annotated frames in {data_path}")
+        self.inputs = ({'input': InferenceSession.cv2_preprocess(frame)} for frame in frames)
+
+    def get_next(self):
+        return next(self.inputs, None)
+
+
+class App:
+
+    def __init__(self, model_file, output_file, mode, data_path, samples, per_channel):
+        self.model_file = pathlib.Path(model_file or DEFAULT_MODEL_FILE)
+        self.output_file = output_file
+        self.mode = mode
+        self.data_path = data_path
+        self.samples = samples
+        self.per_channel = per_channel
+
+    def run(self):
+        if self.mode == 'static' and self.data_path is None:
+            parser.error("static quantization requires --data-path")
+        with tempfile.TemporaryDirectory() as tmp:
+            # folds batch normalization and upgrades the opset, as quantization requires
+            preprocessed_file = pathlib.Path(tmp) / self.model_file.name
+            quant_pre_process(self.model_file, preprocessed_file, skip_symbolic_shape=True)
+            self.quantize(preprocessed_file)
+
+    def quantize(self, model_file):
+        if self.mode == 'dynamic':
+            quantization.quantize_dynamic(
+                model_file,
+                self.output_file,
+                per_channel=self.per_channel,
+                weight_type=quantization.QuantType.QUInt8,
+            )
+        else:
+            quantization.quantize_static(
+                model_file,
+                self.output_file,
+                CalibrationDataReader(self.data_path, self.samples),
+                per_channel=self.per_channel,
+            )
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    App(
+        model_file=args.model,
+        output_file=pathlib.Path(args.output),
+        mode=args.mode,
+        data_path=pathlib.Path(args.data_path) if args.data_path else None,
+        samples=args.samples,
+        per_channel=args.per_channel,
+    ).run()
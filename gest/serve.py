@@ -0,0 +1,195 @@
+import argparse
+import copy
+import logging
+import os
+import pathlib
+import queue
+import signal
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+from gest.inference import (
+    CvCameraInferencePipeline, add_capture_arguments, add_scheduler_arguments, add_session_arguments,
+    budget_from_args, capture_options_from_args, flow_tracker_from_args, motion_gate_from_args, scheduler_from_args,
+    session_options_from_args,
+)
+from gest.pipeline import Broadcast, Factory, Pipeline, SharedMemoryChannel
+from gest.sources import add_source_arguments, source_from_args
+
+# items are unpickled from the socket, so it's kept in a directory only the user can access
+DEFAULT_SOCKET = pathlib.Path(os.environ['XDG_RUNTIME_DIR']) / 'gest.sock' if os.environ.get('XDG_RUNTIME_DIR') \
+    else pathlib.Path(tempfile.gettempdir()) / f'gest-{os.getuid()}' / 'gest.sock'
+
+# events of App.run besides connections
+LEFT = object()
+ENDED = object()
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--camera", help="Camera index, or several to infer together", type=int, nargs="+", default=[0])
+parser.add_argument("--model", help="Model file")
+parser.add_argument("--socket", help="Unix socket to serve on", type=pathlib.Path, default=DEFAULT_SOCKET)
+add_source_arguments(parser)
+add_capture_arguments(parser)
+add_session_arguments(parser)
+add_scheduler_arguments(parser)
+parser.add_argument("--preallocate", help="Preprocess into preallocated buffers", action="store_true")
+
+
+def check_owned(path, private=False):
+    status = path.lstat()
+    if status.st_uid != os.getuid():
+        raise PermissionError(f"{path} belongs to another user")
+    if private and status.st_mode & 0o077:
+        raise PermissionError(f"{path} is accessible by other users")
+
+
+def published(item):
+    item = copy.copy(item)
+    item.preprocessed = None
+    item.raw_inference_result = None
+    return item
+
+
+class RemoteInferencePipeline(Pipeline):
+    """Items inferred by ``python -m gest.serve``, like those of ``CvCameraInferencePipeline``."""
+
+    Item = CvCameraInferencePipeline.Item
+
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        super().__init__([self.remote_inference], default_input_factory=self.item_factory)
+        self.socket_path = socket_path
+
+    def item_factory(self):
+        return Factory(self.Item)
+
+    def remote_inference(self, items):
+        check_owned(self.socket_path)
+        connection = Client(str(self.socket_path), family='AF_UNIX')
+        channel = SharedMemoryChannel(connection=connection, **connection.recv())
+        try:
+            for _, item in zip(items, channel):
+                item.latency = time.monotonic() - item.captured_at
+                yield item
+        finally:
+            channel.disconnect()
+
+
+class App:
+
+    def __init__(self, camera, model_file, socket_path, session_options=None, scheduler=None,
+                 motion_gate=None, flow_tracker=None, budget=None, capture_options=None, preallocate=False):
+        self.pipeline = CvCameraInferencePipeline(
+            camera, model_file, session_options=session_options, scheduler=scheduler,
+            motion_gate=motion_gate, flow_tracker=flow_tracker, budget=budget,
+            capture_options=capture_options, preallocate=preallocate,
+        )
+        self.socket_path = socket_path
+
+    def run(self):
+        self.socket_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if self.socket_path == DEFAULT_SOCKET:
+            check_owned(self.socket_path.parent, private=True)
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        listener = Listener(str(self.socket_path), family='AF_UNIX')
+        os.chmod(self.socket_path, 0o600)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+        logger.info(f"Serving on {self.socket_path}")
+        # accepted connections, and LEFT or ENDED as clients leave or the pipeline stops
+        events = queue.Queue()
+        threading.Thread(target=self.accept, args=(listener, events), daemon=True, name='accept').start()
+        try:
+            while self.serve_clients(events):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+
+    @staticmethod
+    def accept(listener, events):
+        while True:
+            try:
+                events.put(listener.accept())
+            except OSError:
+                # the listener was closed
+                return
+
+    @staticmethod
+    def watch(last_stage, events):
+        last_stage.join()
+        events.put(ENDED)
+
+    def serve_clients(self, events):
+        """Runs the pipeline from when a client connects until the last one leaves.
+
+        Returns False if the pipeline stopped by itself instead, like at the end of a video file.
+        """
+        connection = events.get()
+        if connection is LEFT or connection is ENDED:
+            return True
+        logger.info("Starting the pipeline")
+        with self.pipeline.threaded(channels=self.channels()) as stream:
+            last_stage = stream.threads[-1]
+            threading.Thread(target=self.watch, args=(last_stage, events), daemon=True).start()
+            clients = 0
+            while True:
+                if connection is LEFT:
+                    clients -= 1
+                elif connection is ENDED:
+                    # or that of a previous run
+                    if not last_stage.is_alive():
+                        logger.info("The pipeline stopped")
+                        return False
+                else:
+                    clients += 1
+                    threading.Thread(target=self.serve, args=(stream, connection, events), daemon=True).start()
+                if not clients:
+                    logger.info("Stopping the pipeline until a client connects")
+                    return True
+                connection = events.get()
+
+    def channels(self):
+        if not self.pipeline.unpaced:
+            return None
+        # clients subscribe to the output, so it stays a Broadcast
+        return {**self.pipeline.unpaced_channels(), self.pipeline.components[-1].__name__: Broadcast}
+
+    @staticmethod
+    def serve(stream, connection, events):
+        subscription = stream.subscribe()
+        channel = SharedMemoryChannel(connection=connection)
+        logger.info("Client connected")
+        try:
+            connection.send(channel.handshake())
+            for item in subscription:
+                channel.update(published(item))
+        except (EOFError, OSError):
+            logger.info("Client disconnected")
+        finally:
+            stream.output.unsubscribe(subscription)
+            connection.close()
+            channel.unlink()
+            events.put(LEFT)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    App(
+        camera=source_from_args(args),
+        model_file=args.model,
+        socket_path=args.socket,
+        session_options=session_options_from_args(args),
+        capture_options=capture_options_from_args(args),
+        scheduler=scheduler_from_args(args),
+        motion_gate=motion_gate_from_args(args),
+        flow_tracker=flow_tracker_from_args(args),
+        budget=budget_from_args(args),
+        preallocate=args.preallocate,
+    ).run()
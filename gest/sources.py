@@ -0,0 +1,95 @@
+import pathlib
+import time
+
+import cv2
+
+
+def add_source_arguments(parser):
+    parser.add_argument("--source", type=pathlib.Path,
+                        help="Video file or directory of .jpg images to read frames from, instead of the camera")
+    parser.add_argument("--source-fps", type=float,
+                        help="Frame rate to replay --source at, by default the video's own or 30")
+    parser.add_argument("--unpaced", help="Process every --source frame, as fast as possible", action="store_true")
+
+
+def source_from_args(args):
+    """Returns a frame source for ``--source``, or the ``--camera`` indices."""
+    if args.source is None:
+        return args.camera[0] if len(args.camera) == 1 else args.camera
+    source_class = ImageDirectorySource if args.source.is_dir() else VideoFileSource
+    return source_class(args.source, fps=args.source_fps, realtime=not args.unpaced)
+
+
+class FrameSource:
+    """Frames for ``CvCameraInferencePipeline`` to process instead of those from a camera.
+
+    With ``realtime``, frames come at ``fps`` frames per second, and like with a camera,
+    those not taken before the next one is due are dropped. Otherwise, they come as fast as they are taken.
+    """
+
+    def __init__(self, fps=None, realtime=True):
+        self.fps = fps
+        self.realtime = realtime
+
+    def frames(self):
+        raise NotImplementedError
+
+    def capture(self, items):
+        fps = self.fps or 30.
+        started_at = time.monotonic()
+        for ix, (item, frame) in enumerate(zip(items, self.frames())):
+            if self.realtime:
+                due_at = started_at + ix / fps
+                now = time.monotonic()
+                if now >= due_at + 1 / fps:
+                    continue
+                time.sleep(max(0., due_at - now))
+            item.captured_at = time.monotonic()
+            item.frame = frame
+            yield item
+
+
+class IterableSource(FrameSource):
+    """Frames from a list, a generator or any other iterable."""
+
+    def __init__(self, frames, fps=None, realtime=True):
+        super().__init__(fps, realtime)
+        self.iterable = frames
+
+    def frames(self):
+        return iter(self.iterable)
+
+
+class VideoFileSource(FrameSource):
+    """Frames of a video file, replayed at its own frame rate by default."""
+
+    def __init__(self, path, fps=None, realtime=True):
+        super().__init__(fps, realtime)
+        self.path = pathlib.Path(path)
+        if self.fps is None:
+            capture = cv2.VideoCapture(str(self.path))
+            self.fps = capture.get(cv2.CAP_PROP_FPS) or None
+            capture.release()
+
+    def frames(self):
+        capture = cv2.VideoCapture(str(self.path))
+        try:
+            while True:
+                returned, frame = capture.read()
+                if not returned:
+                    break
+                yield frame
+        finally:
+            capture.release()
+
+
+class ImageDirectorySource(FrameSource):
+    """Frames of the ``.jpg`` images in a directory, like those saved by ``static.AnnotatedGestureManager``."""
+
+    def __init__(self, path, fps=None, realtime=True):
+        super().__init__(fps, realtime)
+        self.path = pathlib.Path(path)
+
+    def frames(self):
+        for path in sorted(self.path.glob('*.jpg')):
+            yield cv2.imread(str(path))
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+onnx = pytest.importorskip('onnx')
+
+from gest.fold import fold  # noqa: E402
+from gest.inference import DEFAULT_MODEL_FILE, InferenceSession  # noqa: E402
+
+
+@pytest.mark.parametrize('input_size', [(320, 240), (192, 144)])
+def test_folded_model_infers_like_the_plain_one(tmp_path, input_size):
+    folded_file = tmp_path / 'folded.onnx'
+    onnx.save(fold(onnx.load(str(DEFAULT_MODEL_FILE)), input_size), str(folded_file))
+    plain = InferenceSession(input_size=input_size, cache_dir=tmp_path)
+    folded = InferenceSession(folded_file)
+    frame = np.random.RandomState(0).randint(0, 256, (240, 320, 3), dtype=np.uint8)
+    for expected, actual in zip(plain.cv2_run(frame), folded.cv2_run(frame)):
+        np.testing.assert_allclose(actual, expected, atol=1e-4)
@@ -0,0 +1,24 @@
+import gc
+
+import numpy as np
+
+from gest.inference import BufferPool
+
+
+def test_lent_buffer_returns_once_no_view_is_left():
+    pool = BufferPool((2, 3), size=1)
+    buffer = pool.lend()
+    view = buffer[1, ::-1]
+    del buffer
+    gc.collect()
+    assert pool.lend(timeout=0) is None
+    del view
+    gc.collect()
+    assert pool.lend(timeout=0) is not None
+
+
+def test_buffers_are_lent_once_at_a_time():
+    pool = BufferPool((2, 3), size=2)
+    buffers = [pool.lend(), pool.lend()]
+    assert not np.shares_memory(*buffers)
+    assert pool.lend(timeout=0) is None
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from gest.math import HandState, hand_states, relative_average_coordinate
+
+
+def hand(random, height=30, width=40):
+    return np.stack([random.rand(height, width) ** 3, random.rand(height, width)]).astype(np.float32)
+
+
+def test_hand_states_match_per_hand_computation():
+    random = np.random.RandomState(0)
+    inference_result = (hand(random), hand(random))
+    for state, (heatmap, openness) in zip(hand_states(inference_result), inference_result):
+        mask = heatmap > .5
+        assert state == pytest.approx(HandState(
+            score=heatmap.max(),
+            x=relative_average_coordinate(heatmap, axis=1),
+            y=relative_average_coordinate(heatmap, axis=0),
+            openness=openness[mask].mean(),
+        ), rel=1e-5)
+
+
+def test_hand_states_of_empty_heatmaps():
+    random = np.random.RandomState(0)
+    empty = hand(random)
+    empty[0] = 0
+    left, right = hand_states((empty, hand(random)))
+    assert left == HandState(score=0., x=.5, y=.5, openness=0.)
+    assert right.score > 0
@@ -0,0 +1,194 @@
+import contextlib
+import functools
+import itertools
+import threading
+import time
+import types
+
+import numpy as np
+
+from gest.pipeline import Broadcast, Factory, Parallel, Pipeline, Queue, SharedMemoryChannel, Tracer, Updatable
+
+
+def drained(channel):
+    channel.close()
+    return list(channel)
+
+
+def counter():
+    count = iter(range(10 ** 9))
+    return lambda: Factory(lambda: next(count))
+
+
+def numbers(items):
+    yield from items
+
+
+def in_thread(target, timeout=5.):
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+
+def test_updatable_keeps_latest():
+    channel = Updatable()
+    for value in range(3):
+        channel.update(value)
+    assert drained(channel) == [2]
+    assert channel.skipped == 2
+
+
+def test_queue_keeps_order():
+    channel = Queue(3)
+    for value in range(3):
+        channel.update(value)
+    assert drained(channel) == [0, 1, 2]
+    assert channel.skipped == 0
+
+
+def test_queue_drops_oldest():
+    channel = Queue(2, drop_oldest=True)
+    for value in range(4):
+        channel.update(value)
+    assert drained(channel) == [2, 3]
+    assert channel.skipped == 2
+
+
+def test_queue_blocks_until_taken():
+    channel = Queue(1)
+    channel.update(0)
+    updated = threading.Event()
+
+    def update():
+        channel.update(1)
+        updated.set()
+
+    threading.Thread(target=update, daemon=True).start()
+    assert not updated.wait(.1)
+    assert next(iter(channel)) == 0
+    assert updated.wait(1)
+
+
+def test_blocked_queue_update_returns_when_closed():
+    channel = Queue(1)
+    channel.update(0)
+    thread = threading.Thread(target=channel.update, args=(1,), daemon=True)
+    thread.start()
+    channel.discard()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert list(channel) == []
+
+
+def test_broadcast_subscribers_get_values():
+    channel = Broadcast()
+    latest = channel.subscribe()
+    queued = channel.subscribe(Queue(10, drop_oldest=True))
+    for value in range(3):
+        channel.update(value)
+    channel.close()
+    assert list(latest) == [2]
+    assert list(queued) == [0, 1, 2]
+
+
+def test_threaded_run_with_queues_passes_every_value():
+    def limited(items):
+        for item in items:
+            if item >= 100:
+                return
+            yield item
+
+    pipeline = Pipeline([limited, numbers], default_input_factory=counter())
+    with pipeline.threaded(channels={'limited': lambda: Queue(2), 'numbers': lambda: Queue(2)}) as stream:
+        assert list(stream) == list(range(100))
+
+
+def test_threaded_run_exits_while_queue_is_full():
+    pipeline = Pipeline([numbers], default_input_factory=counter())
+
+    def run():
+        with pipeline.threaded(channels={'numbers': lambda: Queue(2)}) as stream:
+            for _ in stream:
+                while stream.output.depth < 2:
+                    time.sleep(.01)
+                break
+
+    assert in_thread(run)
+
+
+def test_parallel_passes_every_value_in_order_in_sequential_runs():
+    def slow(items):
+        for item in items:
+            time.sleep(.001 * (item % 3))
+            if item % 5 == 0:
+                continue
+            yield item
+
+    def limited(items):
+        for item in items:
+            if item >= 50:
+                return
+            yield item
+
+    pipeline = Pipeline([limited, Parallel([slow, slow, slow], name='slow')], default_input_factory=counter())
+    with pipeline.sequential() as stream:
+        assert list(stream) == [item for item in range(50) if item % 5]
+
+
+def test_tracer_spans_start_when_each_item_is_received():
+    def read_ahead(items):
+        previous = None
+        for item in items:
+            if previous is not None:
+                yield previous
+            previous = item
+        yield previous
+
+    tracer = Tracer()
+    tracer.clock = functools.partial(next, itertools.count())
+    assert list(tracer.traced(read_ahead)(iter([10, 11, 12]))) == [10, 11, 12]
+    assert [(started, duration) for _, _, _, started, duration in tracer.events] == [(0, 2), (1, 3), (3, 2)]
+
+
+@contextlib.contextmanager
+def shared_memory_channel(slots=4):
+    channel = SharedMemoryChannel(slots)
+    try:
+        yield channel
+    finally:
+        channel.unlink()
+
+
+def test_shared_memory_channel_restores_values():
+    frame = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    value = types.SimpleNamespace(frame=frame, heatmaps=[(frame * 2, frame.astype(np.float32))], name='item')
+    with shared_memory_channel() as channel:
+        channel.update(value)
+        channel.close()
+        restored, = list(channel)
+    assert restored.name == 'item'
+    assert np.array_equal(restored.frame, frame)
+    (doubled, converted), = restored.heatmaps
+    assert np.array_equal(doubled, frame * 2)
+    assert converted.dtype == np.float32 and np.array_equal(converted, frame)
+
+
+def test_shared_memory_channel_sends_repeated_arrays_once():
+    frame = np.zeros((2, 2))
+    arrays = []
+    exported = SharedMemoryChannel.export(types.SimpleNamespace(frame=frame, frames=[frame]), arrays)
+    assert len(arrays) == 1
+    restored = SharedMemoryChannel.restore(exported, [frame.copy()])
+    assert restored.frames[0] is restored.frame
+
+
+def test_shared_memory_channel_skips_overwritten_values():
+    with shared_memory_channel(slots=2) as channel:
+        channel.update(np.zeros(3))
+        overwritten = channel.receiver.recv()
+        channel.update(np.ones(3))
+        latest = channel.receiver.recv()
+        channel.update(np.full(3, 2.))
+        assert channel.read(overwritten) is None
+        assert np.array_equal(channel.read(latest), np.ones(3))